@@ -0,0 +1,465 @@
+import time
+import weakref
+import asyncio
+import functools
+import contextlib
+import contextvars
+import concurrent.futures
+
+import psite
+import db
+
+# asyncio versions of query/fetch/commit/getvar/setvar.  Statements use
+# the same ? placeholders and translation as db.py.  Native drivers are
+# used when installed (aiosqlite, asyncpg, aiomysql), otherwise the
+# sync db.py code runs on a bounded thread pool; the db_async_driver
+# option set to "thread" forces that.
+#
+# Each task gets its own connection, checked out on first use and
+# returned by release_db(), at the end of "async with connection()",
+# or when the task finishes.
+
+current = contextvars.ContextVar("psite_async_db", default=None)
+
+# asyncio objects belong to one event loop, so each loop has its own
+pools = weakref.WeakKeyDictionary()
+
+executor = None
+executor_workers = None
+
+
+async def aiosqlite_connect():
+    # pip3 install aiosqlite
+    import aiosqlite
+    conn = await aiosqlite.connect(db.sqlite3_filename())
+    for stmt in db.sqlite3_pragmas():
+        await conn.execute(stmt)
+    return conn
+
+
+async def aiosqlite_execute(adb, stmt, args):
+    if adb['cursor'] is not None:
+        await adb['cursor'].close()
+    adb['cursor'] = await adb['conn'].execute(stmt, args)
+
+
+async def aiosqlite_fetch(adb):
+    return await adb['cursor'].fetchone()
+
+
+async def aiosqlite_commit(adb):
+    await adb['conn'].commit()
+
+
+async def aiosqlite_rollback(adb):
+    await adb['conn'].rollback()
+
+
+async def aiosqlite_close(adb):
+    await adb['conn'].close()
+
+
+async def asyncpg_connect():
+    # pip3 install asyncpg
+    import asyncpg
+    cfg = psite.get_cfg()
+    return await asyncpg.connect("postgresql://apache@/{}".format(
+        cfg['dbname']))
+
+
+# asyncpg has no cursors or implicit transactions: results are read
+# whole, and a transaction is opened before the first statement like
+# psycopg2 does
+async def asyncpg_execute(adb, stmt, args):
+    if adb['transaction'] is None:
+        adb['transaction'] = adb['conn'].transaction()
+        await adb['transaction'].start()
+    adb['rows'] = iter(await adb['conn'].fetch(stmt, *args))
+
+
+async def asyncpg_fetch(adb):
+    r = next(adb['rows'], None)
+    return None if r is None else tuple(r)
+
+
+async def asyncpg_commit(adb):
+    if adb['transaction'] is not None:
+        await adb['transaction'].commit()
+        adb['transaction'] = None
+
+
+async def asyncpg_rollback(adb):
+    if adb['transaction'] is not None:
+        await adb['transaction'].rollback()
+        adb['transaction'] = None
+
+
+async def asyncpg_close(adb):
+    await adb['conn'].close()
+
+
+async def aiomysql_connect():
+    # pip3 install aiomysql
+    import aiomysql
+    cfg = psite.get_cfg()
+    params = {}
+    params['db'] = cfg['dbname']
+    if psite.get_option("db_host") is not None:
+        params['host'] = psite.get_option("db_host")
+        params['user'] = psite.get_option("db_user")
+        file = "{}/psite_db_passwd".format(cfg['aux_dir'])
+        params['password'] = psite.slurp_file(file).strip()
+    else:
+        params['unix_socket'] = '/var/run/mysqld/mysqld.sock'
+    return await aiomysql.connect(**params)
+
+
+async def aiomysql_execute(adb, stmt, args):
+    if adb['cursor'] is None:
+        adb['cursor'] = await adb['conn'].cursor()
+    await adb['cursor'].execute(stmt, args if args else None)
+
+
+async def aiomysql_fetch(adb):
+    return await adb['cursor'].fetchone()
+
+
+async def aiomysql_commit(adb):
+    await adb['conn'].commit()
+
+
+async def aiomysql_rollback(adb):
+    await adb['conn'].rollback()
+
+
+async def aiomysql_close(adb):
+    adb['conn'].close()
+
+
+# the thread fallback runs db.py itself in a worker, with the task's
+# connection installed as that thread's db for the duration of a call
+# and reads kept on it
+def in_thread(tdb, fn, *args):
+    db.local.db = tdb
+    db.local.pinned = True
+    try:
+        return fn(*args)
+    finally:
+        db.local.db = None
+        db.local.last = None
+
+
+async def run_in_thread(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(
+        get_executor(), functools.partial(fn, *args))
+
+
+def get_executor():
+    global executor, executor_workers
+    if executor is None:
+        executor_workers = int(psite.get_option(
+            "db_async_threads", psite.get_option("db_pool_max", 10)))
+        executor = concurrent.futures.ThreadPoolExecutor(
+            executor_workers, thread_name_prefix="psite-db")
+    return executor
+
+
+def thread_checkout():
+    db.local.db = None
+    tdb = db.get_db()
+    db.local.db = None
+    return tdb
+
+
+async def thread_connect():
+    return await run_in_thread(thread_checkout)
+
+
+# rows of a select come back with the query, so fetch() needs no
+# further trip to the worker
+def thread_query(tdb, stmt, args):
+    db.query(stmt, args)
+    cur = tdb['cursor']
+    if cur.description is None:
+        return iter(())
+    rows = cur.fetchall()
+    if db.hooks and rows:
+        db.run_hooks("fetch", stmt, 0, len(rows))
+    return iter(rows)
+
+
+async def thread_execute(adb, stmt, args):
+    adb['rows'] = await run_in_thread(in_thread, adb['conn'],
+                                      thread_query, adb['conn'], stmt, args)
+
+
+async def thread_fetch(adb):
+    return next(adb['rows'], None)
+
+
+async def thread_commit(adb):
+    await run_in_thread(in_thread, adb['conn'], db.commit)
+
+
+async def thread_rollback(adb):
+    await run_in_thread(adb['conn']['conn'].rollback)
+
+
+async def thread_close(adb):
+    await run_in_thread(in_thread, adb['conn'], db.release_db)
+
+
+drivers = dict(
+    sqlite3=dict(module="aiosqlite", style="qmark",
+                 connect=aiosqlite_connect, execute=aiosqlite_execute,
+                 fetch=aiosqlite_fetch, commit=aiosqlite_commit,
+                 rollback=aiosqlite_rollback, close=aiosqlite_close),
+    postgres=dict(module="asyncpg", style="numeric",
+                  connect=asyncpg_connect, execute=asyncpg_execute,
+                  fetch=asyncpg_fetch, commit=asyncpg_commit,
+                  rollback=asyncpg_rollback, close=asyncpg_close),
+    mysql=dict(module="aiomysql", style="format",
+               connect=aiomysql_connect, execute=aiomysql_execute,
+               fetch=aiomysql_fetch, commit=aiomysql_commit,
+               rollback=aiomysql_rollback, close=aiomysql_close),
+    thread=dict(module=None, style=None,
+                connect=thread_connect, execute=thread_execute,
+                fetch=thread_fetch, commit=thread_commit,
+                rollback=thread_rollback, close=thread_close))
+
+
+def get_driver():
+    # exits on an unknown db type, like the sync side
+    db.get_backend()
+    dialect = psite.get_cfg()["db"]
+    if psite.get_option("db_async_driver") != "thread":
+        driver = drivers[dialect]
+        try:
+            __import__(driver['module'])
+            return driver
+        except ImportError:
+            pass
+    return drivers['thread']
+
+
+def get_pool():
+    loop = asyncio.get_running_loop()
+    pool = pools.get(loop)
+    if pool is None:
+        driver = get_driver()
+        size = int(psite.get_option("db_pool_max", 10))
+        if driver is drivers['thread']:
+            # thread connections come from the db.py pool and go back
+            # to it; only bound how many tasks hold one
+            get_executor()
+            size = min(size, executor_workers)
+        pool = pools[loop] = dict(driver=driver,
+                                  dialect=psite.get_cfg()["db"],
+                                  idle=[],
+                                  slots=asyncio.Semaphore(size))
+    return pool
+
+
+async def checkout():
+    pool = get_pool()
+    driver = pool['driver']
+    await pool['slots'].acquire()
+    try:
+        if pool['idle'] and driver is not drivers['thread']:
+            conn = pool['idle'].pop()
+        else:
+            conn = await driver['connect']()
+    except BaseException:
+        pool['slots'].release()
+        raise
+    return dict(db=pool['dialect'],
+                driver=driver,
+                pool=pool,
+                conn=conn,
+                cursor=None,
+                rows=iter(()),
+                transaction=None,
+                pending=False,
+                task=None)
+
+
+async def checkin(adb):
+    driver = adb['driver']
+    pool = adb['pool']
+    try:
+        if driver is drivers['thread']:
+            await driver['close'](adb)
+            return
+        try:
+            await driver['rollback'](adb)
+        except Exception:
+            await driver['close'](adb)
+        else:
+            pool['idle'].append(adb['conn'])
+    finally:
+        pool['slots'].release()
+
+
+def release_when_done(adb):
+    def done(task):
+        if adb['task'] is task and not adb.get('released'):
+            task.get_loop().create_task(release(adb))
+    return done
+
+
+async def release(adb):
+    if adb.get('released'):
+        return
+    adb['released'] = True
+    await checkin(adb)
+
+
+async def get_db():
+    task = asyncio.current_task()
+    adb = current.get()
+    # child tasks inherit the context var but not the connection
+    if adb is not None and adb['task'] is task and not adb.get('released'):
+        return adb
+    adb = await checkout()
+    adb['task'] = task
+    current.set(adb)
+    task.add_done_callback(release_when_done(adb))
+    return adb
+
+
+async def release_db():
+    adb = current.get()
+    if adb is None or adb['task'] is not asyncio.current_task():
+        return
+    current.set(None)
+    await release(adb)
+
+
+@contextlib.asynccontextmanager
+async def connection():
+    adb = current.get()
+    held = adb is not None and adb['task'] is asyncio.current_task() \
+        and not adb.get('released')
+    try:
+        yield await get_db()
+    finally:
+        if not held:
+            await release_db()
+
+
+# close idle native connections, e.g. before the loop shuts down
+async def close_pool():
+    pool = pools.pop(asyncio.get_running_loop(), None)
+    if pool is None:
+        return
+    for conn in pool['idle']:
+        await pool['driver']['close'](dict(conn=conn))
+
+
+def translate(adb, stmt):
+    style = adb['driver']['style']
+    if style is None:
+        # db.query translates in the worker
+        return stmt
+    return db.translate_stmt(stmt, adb['db'], style)[0]
+
+
+async def query(stmt, args=()):
+    adb = await get_db()
+    start = time.perf_counter() if db.hooks else None
+    await adb['driver']['execute'](adb, translate(adb, stmt), tuple(args))
+    if not db.is_read_stmt(stmt):
+        adb['pending'] = True
+    if start is not None and adb['driver'] is not drivers['thread']:
+        db.run_hooks("query", stmt, time.perf_counter() - start, None)
+
+
+async def fetch():
+    adb = await get_db()
+    return await adb['driver']['fetch'](adb)
+
+
+async def commit():
+    adb = await get_db()
+    start = time.perf_counter() if db.hooks else None
+    await adb['driver']['commit'](adb)
+    adb['pending'] = False
+    if start is not None and adb['driver'] is not drivers['thread']:
+        db.run_hooks("commit", None, time.perf_counter() - start, None)
+
+
+async def table_exists(table):
+    adb = await get_db()
+    await query(*db.table_exists_query(adb['db'], table))
+    return await fetch() is not None
+
+
+async def vars_versioned():
+    if db.vars_state['versioned'] is None:
+        db.vars_state['versioned'] = await table_exists("vars_version")
+    return db.vars_state['versioned']
+
+
+# same cache and invalidation as db.getvar
+async def check_vars_version():
+    ttl = float(psite.get_option("vars_cache_ttl", 1))
+    now = time.monotonic()
+    checked = db.vars_state['checked']
+    if checked is not None and now - checked < ttl:
+        return
+    if not await vars_versioned():
+        version = now
+    else:
+        await query("select version from vars_version")
+        r = await fetch()
+        version = 0 if r is None else r[0]
+    with db.vars_lock:
+        if version != db.vars_state['version']:
+            db.vars_cache.clear()
+        db.vars_state['checked'] = now
+        db.vars_state['version'] = version
+
+
+async def getvar(name):
+    await check_vars_version()
+    entry = db.cached_var(name)
+    if entry is not None:
+        return entry[0]
+
+    await query("select val from vars where var = ?", (name,))
+    r = await fetch()
+    val = "" if r is None else r[0]
+    db.cache_var(name, val)
+    return val
+
+
+async def has_unique_key(table, column):
+    key = (table, column)
+    if key not in db.unique_keys:
+        adb = await get_db()
+        await query(*db.unique_key_query(adb['db'], table, column))
+        db.unique_keys[key] = await fetch() is not None
+    return db.unique_keys[key]
+
+
+async def setvar(name, val):
+    adb = await get_db()
+    if await has_unique_key("vars", "var"):
+        await query(db.upserts[adb['db']], (name, val))
+    else:
+        # same fallback as db.update_or_insert
+        await query("select 0 from vars where var = ?", (name,))
+        if await fetch() is None:
+            await query("insert into vars (var, val) values (?, ?)",
+                        (name, val))
+        else:
+            await query("update vars set val = ? where var = ?",
+                        (val, name))
+    if await vars_versioned():
+        await query("select version from vars_version")
+        if await fetch() is None:
+            await query("insert into vars_version (version) values (1)")
+        else:
+            await query("update vars_version set version = version + 1")
+    await commit()
+    db.cache_var(name, val)
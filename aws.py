@@ -1,7 +1,10 @@
 import psite
 import hashlib
 import os
+import re
 import sys
+import time
+import concurrent.futures
 
 
 def s3_backup_bucket_name(for_siteid):
@@ -37,33 +40,234 @@ def s3_setup():
     print("don't be surprised if first attempt gets access error")
 
 
+def s3_client(profile=None):
+    # apt-get install python3-boto3
+    import boto3
+    import botocore.config
+
+    session = boto3.Session(profile_name=profile)
+    config = botocore.config.Config(retries=dict(
+        max_attempts=int(psite.get_option("s3_retries", 5)),
+        mode="standard"))
+    # s3_endpoint_url points at minio or another s3 stand-in
+    return session.client("s3",
+                          endpoint_url=psite.get_option("s3_endpoint_url"),
+                          config=config)
+
+
+def transfer_config():
+    import boto3.s3.transfer
+
+    part_size = int(psite.get_option("s3_part_mb", 16)) * 1024 * 1024
+    return boto3.s3.transfer.TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=int(psite.get_option("s3_part_concurrency", 4)))
+
+
+def file_sha256(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as inf:
+        while True:
+            buf = inf.read(1024 * 1024)
+            if not buf:
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+
+def sync_candidates(local_dir):
+    for dirpath, dirnames, filenames in os.walk(local_dir):
+        for name in filenames:
+            if name.startswith(".") or name.endswith(".tmp") or \
+               ".part" in name:
+                continue
+            path = os.path.join(dirpath, name)
+            yield (os.path.relpath(path, local_dir), path)
+
+
+def upload(client, bucket_name, key, path, sha256, config):
+    # the server checks each part against its sha256 as it arrives
+    client.upload_file(path, bucket_name, key,
+                       ExtraArgs=dict(Metadata=dict(sha256=sha256),
+                                      ChecksumAlgorithm="SHA256"),
+                       Config=config)
+    if psite.get_option("s3_verify", 0):
+        # needs s3:GetObject, which the backup policy doesn't grant
+        head = client.head_object(Bucket=bucket_name, Key=key)
+        if head['ContentLength'] != os.path.getsize(path) or \
+           head['Metadata'].get('sha256') != sha256:
+            raise ValueError("s3 verify failed for {}".format(key))
+
+
+# uploads whatever the local manifest doesn't already record as sent,
+# so nothing has to list the bucket
 def s3_sync():
     cfg = psite.get_cfg()
 
     local_dir = "{}/backups".format(cfg['aux_dir'])
     bucket_name = s3_backup_bucket_name(cfg['siteid'])
+    manifest_file = "{}/.s3-manifest.json".format(local_dir)
+    # overlapping cron runs wait for each other instead of both
+    # uploading and then one losing the other's manifest entries
+    with psite.json_lock(manifest_file):
+        s3_sync_locked(cfg, local_dir, bucket_name, manifest_file)
+
 
-    cmd = "aws --profile {} s3 sync {} s3://{}".format(
-        cfg['siteid'], local_dir, bucket_name)
-    print(cmd)
-    if os.system(cmd) != 0:
+def s3_sync_locked(cfg, local_dir, bucket_name, manifest_file):
+    manifest = psite.read_json(manifest_file, {}, fast=True)
+
+    todo = []
+    for key, path in sync_candidates(local_dir):
+        st = os.stat(path)
+        sent = manifest.get(key)
+        if sent is not None and sent['bucket'] == bucket_name and \
+           sent['size'] == st.st_size and sent['mtime'] == st.st_mtime:
+            continue
+        sha256 = file_sha256(path)
+        if sent is not None and sent['bucket'] == bucket_name and \
+           sent['sha256'] == sha256:
+            sent['mtime'] = st.st_mtime
+            continue
+        todo.append((key, path, st, sha256))
+
+    client = s3_client(cfg['siteid'])
+    config = transfer_config()
+    start = time.monotonic()
+    # chunks and dumps, then the snapshot manifests naming them, then
+    # latest.* naming those: each phase only once the one before is
+    # entirely in the bucket
+    total = 0
+    sent = 0
+    errors = 0
+    for phase in range(3):
+        batch = [elt for elt in todo if upload_phase(elt[0]) == phase]
+        if errors:
+            if batch:
+                print("s3 sync: not uploading {} until the rest is"
+                      " sent".format(", ".join([elt[0] for elt in batch])))
+            continue
+        more, errors = upload_batch(client, bucket_name, config, batch,
+                                    manifest)
+        total += more
+        sent += len(batch) - errors
+
+    psite.write_json(manifest_file, manifest, pretty=False, fast=True)
+    secs = max(time.monotonic() - start, 1e-6)
+    print("s3 sync: {} files, {} bytes, {:.1f} secs, {:.1f} MB/s".format(
+        sent, total, secs, total / secs / 1e6))
+    if errors:
         print("aws s3 sync error")
         sys.exit(1)
 
 
+def upload_phase(key):
+    name = os.path.basename(key)
+    if name.startswith("latest."):
+        return 2
+    if key.startswith("snapshots/"):
+        return 1
+    return 0
+
+
+# upload todo in parallel, recording what was sent in manifest
+def upload_batch(client, bucket_name, config, todo, manifest):
+    jobs = int(psite.get_option("s3_concurrency", 4))
+    total = 0
+    errors = 0
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        futures = dict([(pool.submit(upload, client, bucket_name,
+                                     key, path, sha256, config),
+                         (key, st, sha256))
+                        for key, path, st, sha256 in todo])
+        for f in concurrent.futures.as_completed(futures):
+            key, st, sha256 = futures[f]
+            try:
+                f.result()
+            except Exception as e:
+                print("upload {} failed: {}".format(key, e))
+                errors += 1
+                continue
+            print("upload: {} to s3://{}/{}".format(key, bucket_name, key))
+            total += st.st_size
+            manifest[key] = dict(bucket=bucket_name, size=st.st_size,
+                                 mtime=st.st_mtime, sha256=sha256)
+    return total, errors
+
+
+def s3_url(url):
+    m = re.match("s3://([^/]+)/(.+)", url)
+    if m is None:
+        print("bad s3 url {}".format(url))
+        sys.exit(1)
+    return (m.group(1), m.group(2))
+
+
+def s3_chunks(url, chunk_size=1024 * 1024):
+    bucket_name, key = s3_url(url)
+    body = s3_client().get_object(Bucket=bucket_name, Key=key)['Body']
+    yield from body.iter_chunks(chunk_size)
+
+
+# latest.gz or latest.zst, whichever was uploaded last, as a site that
+# changed backup_compress still has the old one in the bucket
+def latest_full_backup(client, bucket_name):
+    import botocore.exceptions
+    import backup
+    found = []
+    for ext in backup.extensions.values():
+        name = "latest.{}".format(ext)
+        try:
+            head = client.head_object(Bucket=bucket_name, Key=name)
+        except botocore.exceptions.ClientError:
+            continue
+        found.append((head['LastModified'], name))
+    if not found:
+        print("no backups in s3://{}".format(bucket_name))
+        sys.exit(1)
+    return max(found)[1]
+
+
 def s3_get_latest():
     if len(sys.argv) < 3:
         print("usage: psite get-latest siteid")
         sys.exit(1)
     for_siteid = sys.argv[2]
 
+    bucket_name = s3_backup_bucket_name(for_siteid)
+    client = s3_client()
+    config = transfer_config()
 
-    cfg = psite.get_cfg()
+    # incremental backups: fetch the latest manifest and the chunks
+    # not already here, then rebuild the dump locally
+    import botocore.exceptions
+    os.makedirs("snapshots", exist_ok=True)
+    try:
+        client.download_file(bucket_name, "snapshots/latest.json",
+                             "snapshots/latest.json")
+    except botocore.exceptions.ClientError:
+        name = latest_full_backup(client, bucket_name)
+        client.download_file(bucket_name, name, name, Config=config)
+        print(name)
+        return
 
-    bucket_name = s3_backup_bucket_name(for_siteid)
+    import backup
+    manifest = psite.read_json("snapshots/latest.json")
+    keys = set()
+    for h in manifest['chunks']:
+        path = backup.chunk_path(".", h, manifest['compress'])
+        if not os.path.exists(path):
+            keys.add(path[2:])
 
-    cmd = "aws s3 cp s3://{}/latest.gz .".format(bucket_name)
-    print(cmd)
-    if os.system(cmd) != 0:
-        print("aws s3 cp error")
-        sys.exit(1)
+    def fetch(key):
+        os.makedirs(os.path.dirname(key), exist_ok=True)
+        client.download_file(bucket_name, key, key + ".tmp", Config=config)
+        os.rename(key + ".tmp", key)
+
+    jobs = int(psite.get_option("s3_concurrency", 4))
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        for f in [pool.submit(fetch, key) for key in sorted(keys)]:
+            f.result()
+
+    backup.rebuild_snapshot("snapshots/latest.json", "latest.gz")
+    print("latest.gz")
@@ -0,0 +1,722 @@
+import os
+import re
+import sys
+import time
+import gzip
+import json
+import zlib
+import hashlib
+import itertools
+import subprocess
+import concurrent.futures
+
+import psite
+import db
+
+chunk_size = 1024 * 1024
+
+extensions = dict(gzip="gz", zstd="zst")
+
+
+def get_compression():
+    method = psite.get_option("backup_compress", "gzip")
+    if method not in extensions:
+        print("unknown backup_compress {}".format(method))
+        sys.exit(1)
+    level = int(psite.get_option("backup_level",
+                                 6 if method == "gzip" else 3))
+    return (method, level)
+
+
+def compress(buf, method, level):
+    if method == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compress(buf)
+    return gzip.compress(buf, compresslevel=level)
+
+
+def decompress(buf, method):
+    if method == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(buf)
+    return gzip.decompress(buf)
+
+
+def open_compressed(filename, method, level):
+    if method == "zstd":
+        # pip3 install zstandard
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).stream_writer(
+            open(filename, "wb"), closefd=True)
+    return gzip.open(filename, "wb", compresslevel=level)
+
+
+def mysql_dump_cmd(tables=(), args=()):
+    cfg = psite.get_cfg()
+    cmd = []
+    cmd.append("mysqldump")
+    if psite.get_option("db_host") is not None:
+        cmd.append("--login-path={}".format(cfg['siteid']))
+
+    cmd.append("--single-transaction")
+    cmd.append("--add-drop-table")
+    cmd.extend(args)
+    cmd.append(cfg['dbname'])
+    cmd.extend(tables)
+    return cmd
+
+
+# --clean --if-exists makes the dump drop what it is about to create,
+# so it restores over an existing database like the mysql dumps do
+def postgres_dump_cmd(tables=(), args=("--clean", "--if-exists")):
+    cfg = psite.get_cfg()
+    cmd = []
+    cmd.append("pg_dump")
+    cmd.append("--dbname={}".format(cfg['dbname']))
+    cmd.append("--no-owner")
+    cmd.append("--no-acl")
+    cmd.append("--lock-wait-timeout=60000")
+    cmd.extend(args)
+    for table in tables:
+        cmd.append("--table={}".format(table))
+    return cmd
+
+
+dump_cmds = dict(mysql=mysql_dump_cmd, postgres=postgres_dump_cmd)
+
+
+def command_chunks(cmd):
+    print(" ".join(cmd))
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    while True:
+        buf = proc.stdout.read(chunk_size)
+        if not buf:
+            break
+        yield buf
+    if proc.wait() != 0:
+        print("db dump error")
+        sys.exit(1)
+
+
+# copy a consistent snapshot with the online backup api, then dump
+# the copy so the live database is only locked for the page copy
+def sqlite3_chunks(backups_dir):
+    import sqlite3
+    cfg = psite.get_cfg()
+    snapshot = "{}/.snapshot.db".format(backups_dir)
+    if os.path.exists(snapshot):
+        os.remove(snapshot)
+
+    src = sqlite3.connect("{}/{}.db".format(cfg['aux_dir'], cfg['dbname']))
+    dst = sqlite3.connect(snapshot)
+    try:
+        src.backup(dst)
+        src.close()
+        buf = []
+        size = 0
+        for line in dst.iterdump():
+            buf.append(line)
+            buf.append("\n")
+            size += len(line) + 1
+            if size >= chunk_size:
+                yield "".join(buf).encode("utf-8")
+                buf = []
+                size = 0
+        yield "".join(buf).encode("utf-8")
+    finally:
+        dst.close()
+        os.remove(snapshot)
+
+
+def dump_chunks(backups_dir):
+    cfg = psite.get_cfg()
+    if cfg["db"] == "sqlite3":
+        return sqlite3_chunks(backups_dir)
+    if cfg["db"] == "mysql":
+        # a line per row, as postgres COPY has: with multi-row inserts
+        # one changed row changes a whole line and every chunk after it
+        return command_chunks(mysql_dump_cmd(
+            args=("--skip-extended-insert",)))
+    return command_chunks(dump_cmds[cfg["db"]]())
+
+
+# returns the number of uncompressed bytes written
+def write_compressed(filename, chunks, method, level):
+    raw = 0
+    with open_compressed(filename, method, level) as outf:
+        for buf in chunks:
+            outf.write(buf)
+            raw += len(buf)
+    return raw
+
+
+# runs in a worker process: one table to one compressed member file
+def dump_part(cmd, filename, method, level):
+    return write_compressed(filename, command_chunks(cmd), method, level)
+
+
+def list_tables():
+    cfg = psite.get_cfg()
+    if cfg["db"] == "mysql":
+        db.query("select table_name from information_schema.tables"
+                 " where table_schema = ? order by table_name",
+                 (cfg['dbname'],))
+    else:
+        db.query("select table_name from information_schema.tables"
+                 " where table_schema = 'public' order by table_name")
+    return [r[0] for r in db.fetchall()]
+
+
+# postgres parts: the schema before the data (types, functions,
+# extensions, tables), each table's rows, the sequence values, then
+# indexes, constraints and triggers.  All of them read the snapshot
+# exported here, which stays valid while this transaction is open.
+def postgres_parts(tables):
+    with db.primary_reads():
+        db.query("select sequence_name from information_schema.sequences"
+                 " where sequence_schema = 'public'"
+                 " order by sequence_name")
+        seqs = [r[0] for r in db.fetchall()]
+        db.query("select pg_export_snapshot()")
+        snapshot = "--snapshot={}".format(db.fetch()[0])
+    cmds = [postgres_dump_cmd((), ("--clean", "--if-exists",
+                                   "--section=pre-data", snapshot))]
+    for table in tables:
+        cmds.append(postgres_dump_cmd([table], ("--data-only", snapshot)))
+    if seqs:
+        cmds.append(postgres_dump_cmd(seqs, ("--data-only", snapshot)))
+    cmds.append(postgres_dump_cmd((), ("--section=post-data", snapshot)))
+    return cmds
+
+
+# each part is dumped by its own process into its own gzip member or
+# zstd frame; concatenated in order they decompress as one stream.
+# postgres parts share one snapshot; on mysql each table is its own
+# --single-transaction dump, so rows written during the backup can be
+# in one table's dump and missing from another's.
+def parallel_dump(filename, jobs, method, level):
+    cfg = psite.get_cfg()
+    tables = list_tables()
+    if cfg["db"] == "postgres":
+        cmds = postgres_parts(tables)
+    else:
+        cmds = [mysql_dump_cmd([table]) for table in tables]
+    parts = ["{}.part{}".format(filename, i) for i in range(len(cmds))]
+    try:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            futures = [pool.submit(dump_part, cmd, part, method, level)
+                       for cmd, part in zip(cmds, parts)]
+            raw = sum([f.result() for f in futures])
+    finally:
+        if cfg["db"] == "postgres":
+            # ends the transaction holding the exported snapshot
+            db.get_db()['conn'].rollback()
+
+    with open(filename, "wb") as outf:
+        for part in parts:
+            with open(part, "rb") as inf:
+                while True:
+                    buf = inf.read(chunk_size)
+                    if not buf:
+                        break
+                    outf.write(buf)
+            os.remove(part)
+    return raw
+
+
+def report(what, raw, filename, secs):
+    size = os.path.getsize(filename)
+    secs = max(secs, 1e-6)
+    print("{}: {} bytes raw, {} bytes compressed, {:.1f} secs,"
+          " {:.1f} MB/s".format(what, raw, size, secs,
+                                raw / secs / 1e6))
+
+
+def get_backups_dir():
+    cfg = psite.get_cfg()
+    backups_dir = "{}/backups".format(cfg['aux_dir'])
+    if not os.path.exists(backups_dir):
+        os.mkdir(backups_dir, 0o775)
+    return backups_dir
+
+
+# content defined chunking on line boundaries: a chunk ends after a
+# line whose crc has the low chunk_mask bits clear, so an edit only
+# changes the chunks around it.  lines longer than chunk_max are cut.
+chunk_min = 256 * 1024
+chunk_max = 4 * 1024 * 1024
+chunk_mask = 0x1fff
+
+
+def split_chunks(chunks):
+    cur = []
+    size = 0
+    rest = b""
+    for buf in chunks:
+        lines = (rest + buf).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            line += b"\n"
+            cur.append(line)
+            size += len(line)
+            if size >= chunk_max or \
+               (size >= chunk_min and zlib.crc32(line) & chunk_mask == 0):
+                yield b"".join(cur)
+                cur = []
+                size = 0
+        while len(rest) >= chunk_max:
+            cur.append(rest[:chunk_max])
+            rest = rest[chunk_max:]
+            yield b"".join(cur)
+            cur = []
+            size = 0
+    cur.append(rest)
+    buf = b"".join(cur)
+    if buf:
+        yield buf
+
+
+def chunk_path(backups_dir, h, method):
+    return "{}/chunks/{}/{}.{}".format(backups_dir, h[:2], h,
+                                       extensions[method])
+
+
+# returns the chunk hash, only writing chunks not already stored
+def store_chunk(backups_dir, buf, method, level, stats):
+    h = hashlib.sha256(buf).hexdigest()
+    path = chunk_path(backups_dir, h, method)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), 0o775, exist_ok=True)
+        with open(path + ".tmp", "wb") as outf:
+            outf.write(compress(buf, method, level))
+        os.rename(path + ".tmp", path)
+        stats['new'] += 1
+        stats['new_bytes'] += len(buf)
+    return h
+
+
+def snapshots_dir(backups_dir):
+    return "{}/snapshots".format(backups_dir)
+
+
+def write_manifest(filename, manifest):
+    with open(filename + ".tmp", "w") as f:
+        f.write(json.dumps(manifest, sort_keys=True, indent=2))
+        f.write("\n")
+    os.rename(filename + ".tmp", filename)
+
+
+def snapshot_chunks(manifest_file):
+    manifest = psite.read_json(manifest_file)
+    backups_dir = os.path.dirname(os.path.dirname(
+        os.path.realpath(manifest_file)))
+    for h in manifest['chunks']:
+        with open(chunk_path(backups_dir, h, manifest['compress']),
+                  "rb") as inf:
+            yield decompress(inf.read(), manifest['compress'])
+
+
+def rebuild_snapshot(manifest_file, filename):
+    return write_compressed(filename, snapshot_chunks(manifest_file),
+                            "gzip", 6)
+
+
+# keep the newest backup_keep snapshots (all when 0), then remove
+# chunks that no remaining snapshot refers to
+def prune_snapshots(backups_dir):
+    keep = int(psite.get_option("backup_keep", 0))
+    sdir = snapshots_dir(backups_dir)
+    # oldest first; names from the same second don't sort by age
+    names = sorted([name for name in os.listdir(sdir)
+                    if name.endswith(".json") and name != "latest.json"],
+                   key=lambda name: (os.path.getmtime(
+                       "{}/{}".format(sdir, name)), name))
+    if keep > 0 and len(names) > keep:
+        for name in names[:-keep]:
+            print("prune {}".format(name))
+            os.remove("{}/{}".format(sdir, name))
+        names = names[-keep:]
+
+    used = set()
+    for name in names:
+        manifest = psite.read_json("{}/{}".format(sdir, name))
+        used.update([chunk_path(backups_dir, h, manifest['compress'])
+                     for h in manifest['chunks']])
+
+    removed = 0
+    for dirpath, dirnames, filenames in os.walk(
+            "{}/chunks".format(backups_dir)):
+        for name in filenames:
+            path = "{}/{}".format(dirpath, name)
+            if path not in used:
+                os.remove(path)
+                removed += 1
+    if removed:
+        print("pruned {} chunks".format(removed))
+
+
+# overlapping runs take turns, so that one's pruning can't remove the
+# chunks another has stored but not yet put in a manifest
+def incremental_backup(backups_dir, method, level):
+    sdir = snapshots_dir(backups_dir)
+    if not os.path.exists(sdir):
+        os.mkdir(sdir, 0o775)
+    with psite.json_lock("{}/.backup".format(sdir)):
+        incremental_backup_locked(backups_dir, sdir, method, level)
+
+
+def incremental_backup_locked(backups_dir, sdir, method, level):
+    cfg = psite.get_cfg()
+    # the pid keeps two runs in the same second from sharing a name
+    ts = time.strftime("%Y%m%dT%H%M%S")
+    name = "{}-{}-{}.json".format(cfg['siteid'], ts, os.getpid())
+    stats = dict(new=0, new_bytes=0)
+    hashes = []
+    raw = 0
+
+    start = time.monotonic()
+    with psite.phase("dump"):
+        for buf in split_chunks(dump_chunks(backups_dir)):
+            hashes.append(store_chunk(backups_dir, buf, method, level,
+                                      stats))
+            raw += len(buf)
+    secs = max(time.monotonic() - start, 1e-6)
+
+    write_manifest("{}/{}".format(sdir, name),
+                   dict(siteid=cfg['siteid'], ts=ts, db=cfg['db'],
+                        compress=method, bytes=raw, chunks=hashes))
+    print("backup: {} bytes raw in {} chunks, {} new chunks with {} bytes,"
+          " {:.1f} secs, {:.1f} MB/s".format(
+              raw, len(hashes), stats['new'], stats['new_bytes'],
+              secs, raw / secs / 1e6))
+
+    latest = "{}/latest.json".format(sdir)
+    if os.path.lexists(latest):
+        os.remove(latest)
+    os.symlink(name, latest)
+    print(latest)
+
+    with psite.phase("prune"):
+        prune_snapshots(backups_dir)
+
+
+def do_backup():
+    cfg = psite.get_cfg()
+
+    backups_dir = get_backups_dir()
+    method, level = get_compression()
+    jobs = int(psite.get_option("backup_jobs", 1))
+
+    if psite.get_option("backup_mode", "full") == "incremental":
+        incremental_backup(backups_dir, method, level)
+        return
+
+    ts = time.strftime("%Y%m%dT%H%M%S")
+    ext = extensions[method]
+    zname = "{}-{}.sql.{}".format(cfg['siteid'], ts, ext)
+    filename = "{}/{}".format(backups_dir, zname)
+
+    start = time.monotonic()
+    with psite.phase("dump"):
+        if jobs > 1 and cfg["db"] != "sqlite3":
+            raw = parallel_dump(filename, jobs, method, level)
+        else:
+            raw = write_compressed(filename, dump_chunks(backups_dir),
+                                   method, level)
+    report("backup", raw, filename, time.monotonic() - start)
+
+    # also drop a latest link left from another backup_compress
+    for other in extensions.values():
+        latest = "{}/latest.{}".format(backups_dir, other)
+        if os.path.lexists(latest):
+            os.remove(latest)
+    latest = "{}/latest.{}".format(backups_dir, ext)
+
+    os.symlink(zname, latest)
+    print(latest)
+
+
+def file_chunks(filename):
+    with open(filename, "rb") as inf:
+        while True:
+            buf = inf.read(chunk_size)
+            if not buf:
+                break
+            yield buf
+
+
+# decompress gzip members or zstd frames back to back, as written by
+# parallel dumps; anything else is taken to be plain sql
+def decompress_chunks(chunks):
+    chunks = iter(chunks)
+    first = next(chunks, b"")
+    if first[:2] == b"\x1f\x8b":
+        def new():
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif first[:4] == b"\x28\xb5\x2f\xfd":
+        import zstandard
+
+        def new():
+            return zstandard.ZstdDecompressor().decompressobj()
+    else:
+        yield first
+        yield from chunks
+        return
+
+    d = new()
+    for data in itertools.chain([first], chunks):
+        while data:
+            out = d.decompress(data)
+            if out:
+                yield out
+            if not d.eof:
+                break
+            data = d.unused_data
+            d = new()
+
+
+def source_chunks(name):
+    if name.startswith("s3://"):
+        import aws
+        chunks = aws.s3_chunks(name, chunk_size)
+    elif name.endswith(".json"):
+        return snapshot_chunks(name)
+    else:
+        chunks = file_chunks(name)
+    return decompress_chunks(chunks)
+
+
+def progress(chunks, stats):
+    start = time.monotonic()
+    last = start
+    for buf in chunks:
+        stats['bytes'] += len(buf)
+        now = time.monotonic()
+        if now - last >= 5:
+            print("restore: {:.1f} MB, {:.1f} MB/s".format(
+                stats['bytes'] / 1e6, stats['bytes'] / (now - start) / 1e6))
+            last = now
+        yield buf
+
+
+def text_lines(chunks):
+    rest = b""
+    for buf in chunks:
+        lines = (rest + buf).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line.decode("utf-8") + "\n"
+    if rest:
+        yield rest.decode("utf-8")
+
+
+index_re = re.compile(r"\s*create\s+(unique\s+)?index\b", re.I)
+constraint_re = re.compile(r"\s*alter\s+table\b.*\badd\s+constraint\b"
+                           r".*\b(primary\s+key|unique|foreign\s+key)\b",
+                           re.I | re.S)
+
+
+# 0 for statements to run in order, 1 for index builds deferred to
+# after the data load, 2 for foreign keys which need those indexes
+def restore_phase(stmt):
+    if index_re.match(stmt):
+        return 1
+    m = constraint_re.match(stmt)
+    if m is None:
+        return 0
+    return 2 if m.group(1).lower().startswith("foreign") else 1
+
+
+def sqlite3_restore(chunks):
+    import sqlite3
+    cfg = psite.get_cfg()
+    target = "{}/{}.db".format(cfg['aux_dir'], cfg['dbname'])
+    scratch = "{}.restore".format(target)
+    if os.path.exists(scratch):
+        os.remove(scratch)
+
+    conn = sqlite3.connect(scratch, isolation_level=None)
+    conn.execute("pragma journal_mode = off")
+    conn.execute("pragma synchronous = off")
+    conn.execute("begin")
+    deferred = []
+    buf = []
+    for line in text_lines(chunks):
+        buf.append(line)
+        if not line.rstrip().endswith(";"):
+            continue
+        stmt = "".join(buf)
+        if not sqlite3.complete_statement(stmt):
+            continue
+        buf = []
+        if stmt.strip().upper() in ("BEGIN TRANSACTION;", "COMMIT;"):
+            continue
+        if restore_phase(stmt):
+            deferred.append(stmt)
+        else:
+            conn.execute(stmt)
+    for stmt in deferred:
+        print(stmt.strip())
+        conn.execute(stmt)
+    conn.execute("commit")
+
+    # the backup api swaps the pages in under any open connections
+    live = sqlite3.connect(target)
+    conn.backup(live)
+    live.close()
+    conn.close()
+    os.remove(scratch)
+
+
+# feeds the data lines of a COPY ... FROM stdin to copy_expert
+class CopyData:
+    def __init__(self, lines):
+        self.lines = lines
+        self.buf = ""
+        self.done = False
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buf) < size):
+            line = next(self.lines, "\\.\n")
+            if line.rstrip("\n") == "\\.":
+                self.done = True
+            else:
+                self.buf += line
+        if size < 0:
+            size = len(self.buf)
+        out = self.buf[:size]
+        self.buf = self.buf[size:]
+        return out
+
+
+# psql meta-commands pg_dump may write between statements; \restrict
+# and \unrestrict (pg_dump 17.6, 16.10, ...) only guard psql against a
+# hostile dump and have nothing to do here
+psql_ignored = ["restrict", "unrestrict"]
+
+
+def psql_command(line):
+    words = line[1:].split()
+    if not words or words[0] not in psql_ignored:
+        print("restore: skipping psql command {}".format(line.strip()))
+
+
+# pg_dump statements end with ; at the end of a line, outside quotes.
+# COPY data never gets here: CopyData reads it from the same lines.
+def postgres_statements(lines):
+    buf = []
+    quotes = 0
+    dollars = 0
+    for line in lines:
+        if not buf and (line.startswith("--") or not line.strip()):
+            continue
+        if not buf and line.startswith("\\"):
+            psql_command(line)
+            continue
+        buf.append(line)
+        quotes += line.count("'")
+        dollars += len(re.findall(r"\$\w*\$", line))
+        if line.rstrip().endswith(";") and quotes % 2 == 0 and \
+           dollars % 2 == 0:
+            yield "".join(buf)
+            buf = []
+            quotes = 0
+            dollars = 0
+
+
+def run_deferred(stmts):
+    def run(stmt):
+        with db.connection() as d:
+            print(stmt.strip())
+            d['cursor'].execute(stmt)
+            d['pending'] = True
+            db.commit()
+
+    jobs = int(psite.get_option("restore_jobs", 4))
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        for f in [pool.submit(run, stmt) for stmt in stmts]:
+            f.result()
+
+
+def postgres_restore(chunks):
+    d = db.get_db()
+    cur = d['cursor']
+    deferred = {1: [], 2: []}
+    lines = text_lines(chunks)
+    for stmt in postgres_statements(lines):
+        phase = restore_phase(stmt)
+        if phase:
+            deferred[phase].append(stmt)
+        elif re.match(r"\s*copy\b.*\bfrom\s+stdin\s*;", stmt, re.I | re.S):
+            cur.copy_expert(stmt, CopyData(lines))
+        else:
+            cur.execute(stmt)
+    d['pending'] = True
+    db.commit()
+    db.release_db()
+
+    # indexes and keys build in parallel on their own connections
+    run_deferred(deferred[1])
+    run_deferred(deferred[2])
+
+
+def mysql_restore(chunks):
+    cfg = psite.get_cfg()
+    cmd = ["mysql"]
+    if psite.get_option("db_host") is not None:
+        cmd.append("--login-path={}".format(cfg['siteid']))
+
+    create = cmd + ["-Nrse", "create database if not exists `{}`".format(
+        cfg['dbname'])]
+    if subprocess.call(create) != 0:
+        print("can't create database {}".format(cfg['dbname']))
+        sys.exit(1)
+
+    # mysqldump already writes multi-row inserts; skip the per-row
+    # checks and load everything as one transaction
+    cmd.append(cfg['dbname'])
+    print(" ".join(cmd))
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    proc.stdin.write(b"set foreign_key_checks = 0;\n"
+                     b"set unique_checks = 0;\n"
+                     b"set autocommit = 0;\n")
+    for buf in chunks:
+        proc.stdin.write(buf)
+    proc.stdin.write(b"\ncommit;\n")
+    proc.stdin.close()
+    if proc.wait() != 0:
+        print("mysql restore error")
+        sys.exit(1)
+
+
+restore_effects = dict(
+    sqlite3="replacing the whole database",
+    postgres=("dropping and recreating the objects in the dump"
+              " (dumps made without --clean fail on existing tables)"),
+    mysql="dropping and recreating the tables in the dump")
+
+restorers = dict(sqlite3=sqlite3_restore,
+                 postgres=postgres_restore,
+                 mysql=mysql_restore)
+
+
+def restore():
+    cfg = psite.get_cfg()
+
+    if len(sys.argv) < 3:
+        print("usage: psite restore filename|s3://bucket/key [--yes]")
+        sys.exit(1)
+    name = sys.argv[2]
+
+    if "--yes" not in sys.argv[3:]:
+        answer = input("restore {} into {} database {}, {}? [y/N] ".format(
+            name, cfg['db'], cfg['dbname'], restore_effects[cfg['db']]))
+        if answer.strip().lower() not in ("y", "yes"):
+            sys.exit(1)
+
+    stats = dict(bytes=0)
+    start = time.monotonic()
+    restorers[cfg['db']](progress(source_chunks(name), stats))
+    secs = max(time.monotonic() - start, 1e-6)
+    print("restore: {} bytes in {:.1f} secs, {:.1f} MB/s".format(
+        stats['bytes'], secs, stats['bytes'] / secs / 1e6))
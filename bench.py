@@ -0,0 +1,352 @@
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+import psite
+import db
+
+
+# point psite at a throwaway sqlite3 database in dirname
+def scratch_site(dirname, **options):
+    psite.use_config(dict(db="sqlite3",
+                          aux_dir=dirname,
+                          dbname="bench",
+                          siteid="bench-bench"), options)
+    db.pools.clear()
+    db.local.db = None
+    db.get_pool()['checked'] = True
+
+
+def report(name, count, secs):
+    print("{:24} {:8d} rows {:8.3f} secs {:10.0f} rows/sec".format(
+        name, count, secs, count / secs))
+
+
+def bench_insert(count):
+    rows = [(i, "val-{}".format(i)) for i in range(count)]
+
+    def per_row_commit():
+        for row in rows:
+            db.query("insert into t (id, val) values (?, ?)", row)
+            db.commit()
+
+    def per_row():
+        for row in rows:
+            db.query("insert into t (id, val) values (?, ?)", row)
+        db.commit()
+
+    def many():
+        db.query_many("insert into t (id, val) values (?, ?)", rows)
+
+    def bulk():
+        db.bulk_insert("t", ["id", "val"], rows)
+
+    with tempfile.TemporaryDirectory() as dirname:
+        scratch_site(dirname)
+        for name, fn in [("query+commit per row", per_row_commit),
+                         ("query per row", per_row),
+                         ("query_many", many),
+                         ("bulk_insert", bulk)]:
+            db.query("drop table if exists t")
+            db.query("create table t (id integer, val text)")
+            db.commit()
+            start = time.perf_counter()
+            fn()
+            report(name, count, time.perf_counter() - start)
+        db.release_db()
+
+
+def top_level_imports(code):
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          cwd=here, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+    imports = {}
+    for line in proc.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].startswith(" ") and \
+           not fields[2].startswith("  ") and fields[1].strip().isdigit():
+            imports[fields[2].strip()] = int(fields[1])
+    return imports
+
+
+# cumulative microseconds of the imports code does beyond interpreter
+# startup, as reported by python -X importtime
+def import_time(code):
+    startup = top_level_imports("pass")
+    return sum([usecs for name, usecs in top_level_imports(code).items()
+                if name not in startup])
+
+
+# fails when importing psite takes longer than budget milliseconds
+def bench_import(budget):
+    best = {}
+    for i in range(5):
+        for name, code in [("import psite", "import psite"),
+                           ("getvar path", "import psite; psite.getvar"),
+                           ("backup path", "import psite; psite.do_backup")]:
+            usecs = import_time(code)
+            best[name] = min(best.get(name, usecs), usecs)
+
+    for name, usecs in best.items():
+        print("{:24} {:8.1f} ms".format(name, usecs / 1000))
+    if best["import psite"] / 1000 > budget:
+        print("import psite is over the {} ms budget".format(budget))
+        sys.exit(1)
+
+
+def bench_strip(count):
+    import io
+    import striptags
+
+    para = ("<p>Some <b>bold</b> &amp; <a href='/x?a=1&amp;b=2'>linked</a>"
+            " text &lt;here&gt;.</p>\n")
+    docs = [para * (i % 50 + 1) for i in range(count)]
+    plain = ["plain text &amp; no markup " * (i % 50 + 1)
+             for i in range(count)]
+    big = para * 20000
+
+    # the original: a new parser per document, never closed
+    def old_strip(text):
+        s = striptags.MLStripper()
+        s.feed(text)
+        return s.get_data()
+
+    for name, fn in [
+            ("old strip_tags", lambda: [old_strip(d) for d in docs]),
+            ("strip_tags_many", lambda: striptags.strip_tags_many(docs)),
+            ("old plain text", lambda: [old_strip(d) for d in plain]),
+            ("strip_tags plain text",
+             lambda: striptags.strip_tags_many(plain))]:
+        start = time.perf_counter()
+        fn()
+        report(name, count, time.perf_counter() - start)
+
+    if striptags.strip_tags_many(docs) != [old_strip(d) for d in docs]:
+        print("strip_tags output differs from the original")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    text = "".join(striptags.strip_tags_file(io.StringIO(big)))
+    print("{:28} {:8} bytes {:8.3f} secs".format(
+        "strip_tags_file", len(big), time.perf_counter() - start))
+    if text != old_strip(big):
+        print("strip_tags_file output differs from the original")
+        sys.exit(1)
+
+
+# requests doing one indexed select each, concurrency at a time
+def bench_async(count):
+    import asyncio
+    import concurrent.futures
+    import async_db
+
+    concurrency = 50
+    stmt = "select val from t where id = ?"
+
+    def sync_request(i):
+        with db.connection():
+            db.query(stmt, (i % 1000,))
+            return db.fetch()
+
+    def sequential():
+        for i in range(count):
+            sync_request(i)
+        db.release_db()
+
+    def threads():
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(sync_request, range(count)))
+
+    def run_async(driver):
+        psite.set_option("db_async_driver", driver)
+
+        async def request(i, slots):
+            async with slots:
+                async with async_db.connection():
+                    await async_db.query(stmt, (i % 1000,))
+                    return await async_db.fetch()
+
+        async def main():
+            slots = asyncio.Semaphore(concurrency)
+            await asyncio.gather(*[request(i, slots) for i in range(count)])
+            await async_db.close_pool()
+
+        asyncio.run(main())
+
+    with tempfile.TemporaryDirectory() as dirname:
+        scratch_site(dirname, db_pool_max=10)
+        db.query("create table t (id integer primary key, val text)")
+        db.commit()
+        db.bulk_insert("t", ["id", "val"],
+                       [(i, "val-{}".format(i)) for i in range(1000)])
+        db.release_db()
+        for name, fn in [("sync sequential", sequential),
+                         ("sync {} threads".format(concurrency), threads),
+                         ("async native", lambda: run_async("native")),
+                         ("async thread pool", lambda: run_async("thread"))]:
+            if name == "async native":
+                psite.set_option("db_async_driver", "native")
+                if async_db.get_driver() is async_db.drivers['thread']:
+                    print("async native: aiosqlite is not installed")
+                    continue
+            start = time.perf_counter()
+            fn()
+            report(name, count, time.perf_counter() - start)
+
+
+# one writer committing count single-row inserts while readers run
+# point selects, with sqlite's defaults and then with the psite tuning
+def bench_sqlite(count):
+    import sqlite3
+    import threading
+
+    nreaders = 4
+    before = dict(db_sqlite_journal_mode="delete",
+                  db_sqlite_synchronous="full",
+                  db_sqlite_mmap_size=0,
+                  db_sqlite_cache_kb=2000)
+    after = dict(db_sqlite_journal_mode="wal", db_sqlite_readers=1)
+
+    def run(name, options):
+        with tempfile.TemporaryDirectory() as dirname:
+            scratch_site(dirname, **options)
+            db.query("create table t (id integer primary key, val text)")
+            db.commit()
+            db.release_db()
+            done = threading.Event()
+            counts = dict(reads=0, errors=0)
+            lock = threading.Lock()
+
+            def writer():
+                with db.connection():
+                    for i in range(count):
+                        db.query("insert into t (id, val) values (?, ?)",
+                                 (i, "val-{}".format(i)))
+                        db.commit()
+                done.set()
+
+            def reader():
+                reads = errors = 0
+                with db.connection():
+                    while not done.is_set():
+                        try:
+                            db.query("select val from t where id = ?",
+                                     (reads % count,))
+                            db.fetch()
+                            reads += 1
+                        except sqlite3.OperationalError:
+                            errors += 1
+                with lock:
+                    counts['reads'] += reads
+                    counts['errors'] += errors
+
+            threads = [threading.Thread(target=reader)
+                       for i in range(nreaders)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            writer()
+            for t in threads:
+                t.join()
+            secs = time.perf_counter() - start
+            report("{} writes".format(name), count, secs)
+            report("{} reads".format(name), counts['reads'], secs)
+            if counts['errors']:
+                print("{}: {} locked errors".format(name, counts['errors']))
+
+    run("default", before)
+    run("tuned", after)
+
+
+# count setvars committing each, in one transaction(), and in
+# transaction(every=100), with synchronous=full so each commit syncs
+def bench_txn(count):
+    def each():
+        for i in range(count):
+            db.setvar("v{}".format(i % 1000), str(i))
+
+    def one():
+        with db.transaction():
+            each()
+
+    def batched():
+        with db.transaction(every=100):
+            each()
+
+    for journal in ["wal", "delete"]:
+        with tempfile.TemporaryDirectory() as dirname:
+            scratch_site(dirname, db_sqlite_journal_mode=journal,
+                         db_sqlite_synchronous="full")
+            db.query("create table vars (var text, val text)")
+            db.query("create unique index vars_var on vars (var)")
+            db.commit()
+            for name, fn in [("commit each", each),
+                             ("transaction", one),
+                             ("every=100", batched)]:
+                start = time.perf_counter()
+                fn()
+                report("{} {}".format(journal, name), count,
+                       time.perf_counter() - start)
+            db.release_db()
+
+
+# count lookups spread over 100 keys of a reference table, straight
+# through db.query and through each qcache backend
+def bench_qcache(count):
+    import qcache
+
+    stmt = ("select r.val, c.name from ref r join cat c on c.id = r.cat"
+            " where r.id = ?")
+
+    def uncached():
+        for i in range(count):
+            db.query(stmt, (i % 100,))
+            db.fetchall()
+
+    def cached():
+        for i in range(count):
+            qcache.cached_query(stmt, (i % 100,))
+
+    with tempfile.TemporaryDirectory() as dirname:
+        scratch_site(dirname)
+        db.query("create table cat (id integer primary key, name text)")
+        db.query("create table ref (id integer primary key, cat integer,"
+                 " val text)")
+        db.query_many("insert into cat (id, name) values (?, ?)",
+                      [(i, "cat-{}".format(i)) for i in range(10)])
+        db.query_many("insert into ref (id, cat, val) values (?, ?, ?)",
+                      [(i, i % 10, "val-{}".format(i)) for i in range(1000)])
+        for name, backend, fn in [("uncached", None, uncached),
+                                  ("qcache memory", "memory", cached),
+                                  ("qcache sqlite", "sqlite", cached)]:
+            if backend is not None:
+                psite.set_option("qcache_backend", backend)
+                qcache.state['backend'] = None
+                qcache.clear()
+            start = time.perf_counter()
+            fn()
+            report(name, count, time.perf_counter() - start)
+        db.release_db()
+
+
+benches = dict(insert=(bench_insert, 20000),
+               import_time=(bench_import, 10),
+               strip=(bench_strip, 5000),
+               async_db=(bench_async, 5000),
+               sqlite=(bench_sqlite, 2000),
+               txn=(bench_txn, 5000),
+               qcache=(bench_qcache, 50000))
+
+
+def cmd_bench():
+    if len(sys.argv) < 3 or sys.argv[2] not in benches:
+        print("usage: psite bench {} [count]".format(
+            "|".join(sorted(benches))))
+        sys.exit(1)
+    fn, count = benches[sys.argv[2]]
+    if len(sys.argv) >= 4:
+        count = int(sys.argv[3])
+    fn(count)
@@ -3,7 +3,11 @@ import sys
 import re
 import grp
 import time
-import subprocess
+import itertools
+import functools
+import collections
+import threading
+import contextlib
 
 
 import psite
@@ -23,91 +27,711 @@ def make_writable_for_server(filename):
         print("sudo chmod g+w {}".format(filename))
 
 
-db = None
+# one pool per role: "primary" for everything by default, "reader"
+# for the read-only sqlite connections of db_sqlite_readers
+pools = {}
+pool_lock = threading.Lock()
+local = threading.local()
+
+
+# db_sqlite_journal_mode (e.g. "wal") if set, otherwise whatever mode
+# the file already has, as seen by the first primary connection.  The
+# mode is stored in the file, so setting it is a lasting change; wal
+# also needs the php user to be able to write aux_dir for the -wal and
+# -shm files, even to read.
+def sqlite3_journal_mode():
+    mode = psite.get_option("db_sqlite_journal_mode")
+    if mode is None:
+        mode = get_pool().get('journal_mode') or "delete"
+    return str(mode).lower()
+
+
+# pragmas run on every new sqlite connection; the journal mode is only
+# set once per process
+def sqlite3_pragmas():
+    wal = sqlite3_journal_mode() == "wal"
+    synchronous = psite.get_option("db_sqlite_synchronous",
+                                   "normal" if wal else "full")
+    return ["pragma synchronous = {}".format(synchronous),
+            "pragma mmap_size = {}".format(int(psite.get_option(
+                "db_sqlite_mmap_size", 256 * 1024 * 1024))),
+            "pragma cache_size = -{}".format(int(psite.get_option(
+                "db_sqlite_cache_kb", 8192))),
+            "pragma busy_timeout = {}".format(int(psite.get_option(
+                "db_sqlite_busy_ms", 5000)))]
+
+
+def sqlite3_filename():
+    cfg = psite.get_cfg()
+    return "{}/{}.db".format(cfg['aux_dir'], cfg['dbname'])
+
+
+def sqlite3_connect(role="primary"):
+    import sqlite3
+    filename = sqlite3_filename()
+    busy = float(psite.get_option("db_sqlite_busy_ms", 5000)) / 1000
+    cached = int(psite.get_option("db_stmt_cache", 256))
+    primary = get_pool()
+    if role == "reader":
+        if not primary['tuned']:
+            # let a primary connection create the file and set the
+            # journal mode first
+            checkin(checkout())
+        import urllib.parse
+        # connections are handed between threads by the pool
+        conn = sqlite3.connect("file:{}?mode=ro".format(
+                                   urllib.parse.quote(filename)),
+                               uri=True, timeout=busy,
+                               check_same_thread=False,
+                               cached_statements=cached)
+    else:
+        conn = sqlite3.connect(filename, timeout=busy,
+                               check_same_thread=False,
+                               cached_statements=cached)
+        mode = psite.get_option("db_sqlite_journal_mode")
+        if not primary['tuned']:
+            primary['tuned'] = True
+            if mode is not None:
+                conn.execute("pragma journal_mode = {}".format(mode))
+            primary['journal_mode'] = conn.execute(
+                "pragma journal_mode").fetchone()[0]
+        if not primary['checked']:
+            primary['checked'] = True
+            make_writable_for_server(filename)
+            if sqlite3_journal_mode() == "wal":
+                # the -wal and -shm files are made next to the db
+                make_writable_for_server(os.path.dirname(filename))
+    for stmt in sqlite3_pragmas():
+        conn.execute(stmt)
+    return conn
+
+
+# fold the WAL back into the database.  sqlite checkpoints by itself as
+# commits go by, but never past the oldest open reader, so a busy site
+# can keep growing the -wal file; commit() also runs a passive one every
+# db_sqlite_checkpoint_secs, and do-cron a truncating one.
+def wal_checkpoint(mode="passive"):
+    if psite.get_cfg().get("db") != "sqlite3" or \
+       sqlite3_journal_mode() != "wal":
+        return None
+    db = get_db()
+    if db['pending']:
+        return None
+    get_pool()['checkpointed'] = time.monotonic()
+    return db['conn'].execute("pragma wal_checkpoint({})".format(
+        mode)).fetchone()
 
 
-def get_db():
-    global db
-    if db is not None:
-        return db
+# the password of db_user, for db_host and replicas
+def db_password():
+    cfg = psite.get_cfg()
+    file = "{}/psite_db_passwd".format(cfg['aux_dir'])
+    return psite.slurp_file(file).strip()
 
+
+def postgres_connect(role="primary"):
+    # apt-get install python3-psycopg2
+    import psycopg2
+    cfg = psite.get_cfg()
+    dsn = "postgresql://apache@/{}".format(cfg['dbname'])
+    host = replica_host(role)
+    if host is not None:
+        params = dict(host=host,
+                      connect_timeout=int(psite.get_option(
+                          "db_replica_connect_secs", 5)))
+        if psite.get_option("db_user") is not None:
+            params['user'] = psite.get_option("db_user")
+            params['password'] = db_password()
+        conn = psycopg2.connect(dsn, **params)
+        # plain reads shouldn't hold a snapshot open on the replica
+        conn.autocommit = True
+        return conn
+    try:
+        return psycopg2.connect(dsn)
+    except(psycopg2.OperationalError):
+        print("can't connect to database, maybe do:")
+        print("createdb -O apache {}".format(cfg['dbname']))
+        raise
+
+
+def mysql_connect(role="primary"):
+    # apt-get install python3-mysqldb
+    import MySQLdb
     cfg = psite.get_cfg()
-    db = dict(db=cfg["db"])
-
-    if cfg["db"] == "sqlite3":
-        import sqlite3
-        filename = "{}/{}.db".format(cfg['aux_dir'], cfg['dbname'])
-        db['conn'] = sqlite3.connect(filename)
-        make_writable_for_server(filename)
-        db['cursor'] = db['conn'].cursor()
-        db['table_exists'] = sqlite3_table_exists
-        db['column_exists'] = sqlite3_column_exists
-        db['commit'] = sqlite3_commit
+
+    try:
+        params = {}
+        params['db'] = cfg['dbname']
+
+        host = replica_host(role)
+        if host is not None:
+            params['host'] = host
+            params['user'] = psite.get_option("db_user")
+            params['password'] = db_password()
+            params['connect_timeout'] = int(psite.get_option(
+                "db_replica_connect_secs", 5))
+            conn = MySQLdb.connect(**params)
+            # plain reads shouldn't hold a snapshot open on the replica
+            conn.autocommit(True)
+            return conn
+        elif psite.get_option("db_host") is not None:
+            params['host'] = psite.get_option("db_host")
+            params['user'] = psite.get_option("db_user")
+            params['password'] = db_password()
+        else:
+            # get unix_socket name: mysqladmin variables | grep sock
+            params['unix_socket'] = '/var/run/mysqld/mysqld.sock'
+
+        return MySQLdb.connect(**params)
+    except(MySQLdb.OperationalError):
+        print("")
+        print("*******")
+        print("can't connect to database, maybe do:")
+        print("mysql -Nrse 'create database `{}`'".format(cfg['dbname']))
+        print("*******")
+        print("")
+        print("")
+        raise
+
+
+def sqlite3_ping(conn):
+    conn.execute("select 1")
+
+
+def postgres_ping(conn):
+    cur = conn.cursor()
+    cur.execute("select 1")
+    conn.rollback()
+
+
+def mysql_ping(conn):
+    conn.ping()
+
+
+def sqlite3_errors():
+    import sqlite3
+    return sqlite3.OperationalError
+
+
+def postgres_errors():
+    import psycopg2
+    return psycopg2.OperationalError
+
+
+def mysql_errors():
+    import MySQLdb
+    return MySQLdb.OperationalError
+
+
+def sqlite3_all_errors():
+    import sqlite3
+    return sqlite3.Error
+
+
+def postgres_all_errors():
+    import psycopg2
+    return psycopg2.Error
+
+
+def mysql_all_errors():
+    import MySQLdb
+    return MySQLdb.Error
+
+
+def get_backend():
+    cfg = psite.get_cfg()
+    backend = backends.get(cfg.get("db"))
+    if backend is None:
+        print("get_db failed")
+        sys.exit(1)
+    return backend
+
+
+def get_pool(role="primary"):
+    pool = pools.get(role)
+    if pool is not None:
+        return pool
+
+    with pool_lock:
+        pool = pools.get(role)
+        if pool is None:
+            cfg = psite.get_cfg()
+            max_conns = int(psite.get_option("db_pool_max", 10))
+            if role == "reader":
+                max_conns = int(psite.get_option("db_readers_max",
+                                                 max_conns))
+            elif replica_host(role) is not None:
+                max_conns = int(psite.get_option("db_replica_pool_max",
+                                                 max_conns))
+            pool = pools[role] = dict(
+                role=role,
+                backend=get_backend(),
+                readers=(cfg.get("db") == "sqlite3" and
+                         bool(psite.get_option("db_sqlite_readers"))),
+                checkpointed=time.monotonic(),
+                tuned=False,
+                journal_mode=None,
+                idle=[],
+                busy={},
+                checked=False,
+                prepared={},
+                prepare=bool(psite.get_option("db_prepare", False)),
+                cond=threading.Condition(),
+                min=int(psite.get_option("db_pool_min", 1)),
+                max=max_conns,
+                timeout=float(psite.get_option("db_pool_timeout", 30)),
+                check_secs=float(psite.get_option("db_pool_check_secs", 30)),
+                idle_secs=float(psite.get_option("db_pool_idle_secs", 300)))
+    if role == "primary" and (psite.get_option("db_stats") or
+                              psite.get_option("db_slow_ms") is not None):
+        import dbstats
+        dbstats.enable()
+    if role == "primary" and psite.get_option("qcache_backend") == "sqlite":
+        # writes from any process invalidate the shared query cache
+        import qcache
+        qcache.enable()
+    return pool
+
+
+def pool_reclaim(pool):
+    # connections held by threads that exited without release_db()
+    for key, (conn, thread) in list(pool['busy'].items()):
+        if not thread.is_alive():
+            del pool['busy'][key]
+            close_conn(pool, conn)
+
+
+def close_conn(pool, conn):
+    pool['prepared'].pop(id(conn), None)
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def checkout(role="primary"):
+    pool = get_pool(role)
+    backend = pool['backend']
+    deadline = time.monotonic() + pool['timeout']
+
+    with pool['cond']:
+        while True:
+            if pool['idle']:
+                conn, last_used = pool['idle'].pop()
+                break
+            if len(pool['busy']) >= pool['max']:
+                pool_reclaim(pool)
+            if len(pool['busy']) < pool['max']:
+                conn, last_used = None, None
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError("db pool exhausted ({} connections)"
+                                   .format(pool['max']))
+            pool['cond'].wait(remaining)
+        token = object()
+        pool['busy'][id(token)] = (None, threading.current_thread())
+
+    try:
+        if conn is not None and \
+           time.monotonic() - last_used > pool['check_secs']:
+            try:
+                backend['ping'](conn)
+            except Exception:
+                close_conn(pool, conn)
+                conn = None
+        if conn is None:
+            conn = backend['connect'](role)
+    except BaseException:
+        with pool['cond']:
+            pool['busy'].pop(id(token), None)
+            pool['cond'].notify()
+        raise
+
+    with pool['cond']:
+        del pool['busy'][id(token)]
+        pool['busy'][id(conn)] = (conn, threading.current_thread())
+    return conn
+
+
+def checkin(conn, discard=False, role="primary"):
+    pool = get_pool(role)
+    now = time.monotonic()
+    with pool['cond']:
+        pool['busy'].pop(id(conn), None)
+        if not discard:
+            pool['idle'].append((conn, now))
+        # idle connections beyond the minimum are closed once stale
+        while len(pool['idle']) > pool['min'] and \
+                now - pool['idle'][0][1] > pool['idle_secs']:
+            close_conn(pool, pool['idle'].pop(0)[0])
+        pool['cond'].notify()
+    if discard:
+        close_conn(pool, conn)
+
+
+# a thread's primary connection is local.db, others local.<role>
+def held_attr(role):
+    return "db" if role == "primary" else role
+
+
+def get_db(role="primary"):
+    db = getattr(local, held_attr(role), None)
+    if db is not None:
         return db
-    elif cfg["db"] == "postgres":
-        # apt-get install python3-psycopg2
-        import psycopg2
-        dsn = "postgresql://apache@/{}".format(cfg['dbname'])
+
+    pool = get_pool(role)
+    backend = pool['backend']
+    conn = checkout(role)
+    db = dict(db=psite.get_cfg()["db"],
+              role=role,
+              conn=conn,
+              cursor=conn.cursor(),
+              pending=False,
+              prepared=pool['prepared'].setdefault(id(conn), {}),
+              table_exists=backend['table_exists'],
+              column_exists=backend['column_exists'],
+              commit=backend['commit'])
+    setattr(local, held_attr(role), db)
+    return db
+
+
+def held_dbs():
+    return [db for db in [getattr(local, held_attr(role), None)
+                          for role in list(pools)]
+            if db is not None]
+
+
+# give back every connection this thread holds
+def release_db():
+    local.last = None
+    for db in held_dbs():
+        setattr(local, held_attr(db['role']), None)
+        discard = False
         try:
-            db['conn'] = psycopg2.connect(dsn)
-        except(psycopg2.OperationalError):
-            print("can't connect to database, maybe do:")
-            print("createdb -O apache {}".format(cfg['dbname']))
-            raise
-            sys.exit(1)
-        db['cursor'] = db['conn'].cursor()
-        db['table_exists'] = postgres_table_exists
-        db['column_exists'] = postgres_column_exists
-        db['commit'] = postgres_commit
-        return db
-    elif cfg["db"] == "mysql":
-        # apt-get install python3-mysqldb
-        import MySQLdb
+            db['conn'].rollback()
+        except Exception:
+            discard = True
+        checkin(db['conn'], discard, db['role'])
 
+
+def reconnect(db):
+    role = db['role']
+    setattr(local, held_attr(role), None)
+    checkin(db['conn'], discard=True, role=role)
+    return get_db(role)
+
+
+@contextlib.contextmanager
+def connection():
+    held = bool(held_dbs())
+    try:
+        yield get_db()
+    finally:
+        if not held:
+            release_db()
+
+
+def is_read_stmt(stmt):
+    return stmt.lstrip()[:6].lower() in ("select", "pragma")
+
+
+def is_plain_select(stmt):
+    lower = stmt.lower()
+    return lower.lstrip()[:6] == "select" and " for update" not in lower \
+        and " for share" not in lower and "nextval(" not in lower
+
+
+# reads of these tables always go to the primary: a lagging copy of a
+# session or sequence row would be written back over newer data
+primary_tables = set(["sessions", "seqs"])
+read_table_re = re.compile(r"\b(?:from|join)\s+[`\"]?(\w+)", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def reads_primary_table(stmt):
+    for name in read_table_re.findall(stmt):
+        if name.lower() in primary_tables:
+            return True
+    return False
+
+
+# read replicas are listed in the db_replicas option; each gets its
+# own pool under the role "replica:<host>"
+replicas = {}
+replica_lock = threading.Lock()
+replica_turn = itertools.count()
+
+
+def replica_host(role):
+    if role.startswith("replica:"):
+        return role[8:]
+    return None
+
+
+def replica_state(host):
+    state = replicas.get(host)
+    if state is None:
+        with replica_lock:
+            state = replicas.setdefault(host, dict(
+                host=host, errors=0, down_until=0, latency=0.0,
+                lag=0.0, checked=0))
+    return state
+
+
+replica_lag_queries = dict(
+    postgres=("select case"
+              " when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()"
+              " then 0"
+              " else extract(epoch from"
+              "  now() - pg_last_xact_replay_timestamp())"
+              " end"),
+    # mysql 8.0.22+ and mariadb 10.5+, then the old name (removed in
+    # mysql 8.4).  Both need the REPLICATION CLIENT privilege (or
+    # REPLICA MONITOR on mariadb) for db_user:
+    #   grant replication client on *.* to 'user'@'%'
+    mysql=("show replica status", "show slave status"))
+
+
+def mysql_replica_lag(cur):
+    import MySQLdb
+    stmts = replica_lag_queries['mysql']
+    for stmt in stmts:
         try:
-            params = {}
-            params['db'] = cfg['dbname']
-
-            if psite.get_option("db_host") is not None:
-                params['host'] = psite.get_option("db_host")
-                params['user'] = psite.get_option("db_user")
-                file = "{}/psite_db_passwd".format(cfg['aux_dir'])
-                pw = psite.slurp_file(file).strip()
-                params['password'] = pw
-            else:
-                # get unix_socket name: mysqladmin variables | grep sock
-                params['unix_socket'] = '/var/run/mysqld/mysqld.sock'
-
-            db['conn'] = MySQLdb.connect(**params)
-        except(MySQLdb.OperationalError):
-            print("")
-            print("*******")
-            print("can't connect to database, maybe do:")
-            print("mysql -Nrse 'create database `{}`'".format(cfg['dbname']))
-            print("*******")
-            print("")
-            print("")
-            raise
-            sys.exit(1)
+            cur.execute(stmt)
+            break
+        except(MySQLdb.ProgrammingError):
+            # syntax error: a server without this spelling
+            if stmt == stmts[-1]:
+                raise
+    r = cur.fetchone()
+    if r is None:
+        # not a replica, or no privilege to see its status on mariadb
+        return 0.0
+    r = dict(zip([d[0] for d in cur.description], r))
+    lag = r.get("Seconds_Behind_Source", r.get("Seconds_Behind_Master"))
+    if lag is None:
+        # replication stopped
+        return float("inf")
+    return float(lag)
+
 
-        db['cursor'] = db['conn'].cursor()
-        db['table_exists'] = mysql_table_exists
-        db['column_exists'] = mysql_column_exists
-        db['commit'] = mysql_commit
+def replica_lag(db):
+    cur = db['cursor']
+    if db['db'] == "mysql":
+        return mysql_replica_lag(cur)
+    cur.execute(replica_lag_queries[db['db']])
+    r = cur.fetchone()
+    return float(r[0] or 0)
+
+
+def replica_down(state, why):
+    retry = float(psite.get_option("db_replica_retry_secs", 30))
+    state['down_until'] = time.monotonic() + retry
+    state['errors'] = 0
+    print("db replica {} marked down for {:.0f} secs: {}".format(
+        state['host'], retry, why), file=sys.stderr)
+
+
+def replica_failed(db, err):
+    state = replica_state(replica_host(db['role']))
+    setattr(local, held_attr(db['role']), None)
+    if getattr(local, "last", None) is db:
+        local.last = None
+    checkin(db['conn'], discard=True, role=db['role'])
+    state['errors'] += 1
+    if state['errors'] >= int(psite.get_option("db_replica_max_errors", 3)):
+        replica_down(state, err)
+
+
+def replica_ok(state, secs):
+    state['errors'] = 0
+    # moving average for least_latency
+    if state['latency'] == 0:
+        state['latency'] = secs
+    else:
+        state['latency'] = 0.8 * state['latency'] + 0.2 * secs
+
+
+# a healthy replica connection chosen by db_replica_policy
+# (round_robin or least_latency), or None to use the primary
+def replica_db():
+    hosts = psite.get_option("db_replicas") or []
+    policy = psite.get_option("db_replica_policy", "round_robin")
+    check_secs = float(psite.get_option("db_replica_check_secs", 10))
+    max_lag = float(psite.get_option("db_replica_max_lag", 30))
+    # any driver error, such as a missing privilege for the lag check,
+    # takes the replica out rather than failing the read
+    errors = get_backend()['all_errors']()
+    for attempt in range(len(hosts)):
+        now = time.monotonic()
+        healthy = [state for state in map(replica_state, hosts)
+                   if state['down_until'] <= now]
+        if not healthy:
+            return None
+        if policy == "least_latency":
+            state = min(healthy, key=lambda state: state['latency'])
+        else:
+            state = healthy[next(replica_turn) % len(healthy)]
+        role = "replica:{}".format(state['host'])
+        db = None
+        try:
+            db = get_db(role)
+            if now - state['checked'] > check_secs:
+                state['checked'] = now
+                state['lag'] = replica_lag(db)
+        except errors as e:
+            if db is None:
+                replica_down(replica_state(state['host']), e)
+            else:
+                replica_failed(db, e)
+            continue
+        if state['lag'] > max_lag:
+            replica_down(state, "{:.0f} secs behind".format(state['lag']))
+            continue
         return db
+    return None
+
+
+# the connection stmt runs on.  Selects go to a sqlite reader or a
+# replica when the site has them, unless this thread has uncommitted
+# writes, has written since end_request() when replicas are in use, or
+# reads one of primary_tables.
+def query_db(stmt):
+    txn = getattr(local, "read_txn", None)
+    if txn is not None:
+        return txn
+    if getattr(local, "pinned", False) or not is_plain_select(stmt) or \
+       reads_primary_table(stmt):
+        return get_db()
+    primary = getattr(local, "db", None)
+    if primary is not None and primary['pending'] or \
+       getattr(local, "txn", None) is not None:
+        return get_db()
+    if get_pool()['readers']:
+        return get_db("reader")
+    if psite.get_option("db_replicas") and \
+       getattr(local, "sticky_until", 0) < time.monotonic():
+        db = replica_db()
+        if db is not None:
+            return db
+    return get_db()
+
+
+# sends the thread's reads back to replicas and gives back its
+# connections, at the end of a web request or unit of daemon work
+def end_request():
+    local.sticky_until = 0
+    release_db()
+
+
+# run the block's queries on one replica in a read-only transaction,
+# so they see a single consistent snapshot; primary without replicas
+@contextlib.contextmanager
+def read_transaction():
+    db = None
+    if psite.get_option("db_replicas") and \
+       not getattr(local, "read_txn", None):
+        db = replica_db()
+    if db is None:
+        yield get_db()
+        return
+    # replica connections are in autocommit mode
+    if db['db'] == "postgres":
+        db['cursor'].execute("begin transaction read only")
     else:
-        print("get_db failed")
-        sys.exit(1)
+        db['cursor'].execute("start transaction read only")
+    local.read_txn = db
+    try:
+        yield db
+    finally:
+        if local.read_txn is db:
+            local.read_txn = None
+            db['cursor'].execute("rollback")
+
+
+# keep the block's reads on the primary, such as the catalog that a
+# schema change is planned from
+@contextlib.contextmanager
+def primary_reads():
+    pinned = getattr(local, "pinned", False)
+    local.pinned = True
+    try:
+        yield get_db()
+    finally:
+        local.pinned = pinned
 
 
-def sqlite3_table_exists(table):
-    db = get_db()
-    cur = db['cursor']
-    cur.execute("select 1 from sqlite_master"
+# the connection of the last query, for fetching its rows
+def last_db():
+    db = getattr(local, "last", None)
+    if db is None:
+        db = get_db()
+    return db
+
+
+# (stmt, args) telling whether table exists, also used by async_db
+def table_exists_query(dialect, table):
+    if dialect == "sqlite3":
+        return ("select 1 from sqlite_master"
                 " where type = 'table'"
                 "   and name = ?",
                 (table,))
-    return cur.fetchone() is not None
+    elif dialect == "postgres":
+        return ("select 0"
+                " from information_schema.tables"
+                " where table_schema = 'public'"
+                "   and table_name = ?",
+                (table,))
+    return ("select 0"
+            " from information_schema.tables"
+            " where table_schema = ?"
+            "   and table_name = ?",
+            (psite.get_cfg()['dbname'], table))
+
+
+# (stmt, args) returning a row when a unique index or primary key
+# covers exactly column
+def unique_key_query(dialect, table, column):
+    if dialect == "sqlite3":
+        # an integer primary key is the rowid and has no index
+        return ("select l.name"
+                " from pragma_index_list(?) l"
+                " join pragma_index_info(l.name) i"
+                " where l.\"unique\""
+                " group by l.name"
+                " having count(*) = 1 and max(i.name) = ?"
+                " union all"
+                " select name from pragma_table_info(?)"
+                " where pk = 1 and name = ?"
+                "   and (select count(*) from pragma_table_info(?)"
+                "        where pk > 0) = 1",
+                (table, column, table, column, table))
+    elif dialect == "postgres":
+        return ("select 0"
+                " from pg_index x"
+                " join pg_class t on t.oid = x.indrelid"
+                " join pg_namespace n on n.oid = t.relnamespace"
+                " join pg_attribute a"
+                "   on a.attrelid = t.oid and a.attnum = x.indkey[0]"
+                " where n.nspname = 'public'"
+                "   and t.relname = ?"
+                "   and a.attname = ?"
+                "   and x.indisunique and x.indnatts = 1",
+                (table, column))
+    return ("select 0"
+            " from information_schema.statistics"
+            " where table_schema = ?"
+            "   and table_name = ?"
+            "   and non_unique = 0"
+            " group by index_name"
+            " having count(*) = 1 and max(column_name) = ?",
+            (psite.get_cfg()['dbname'], table, column))
+
+
+def sqlite3_table_exists(table):
+    query(*table_exists_query("sqlite3", table))
+    return fetch() is not None
 
 
 def sqlite3_column_exists(table, column):
@@ -122,101 +746,664 @@ def sqlite3_column_exists(table, column):
 
 
 def sqlite3_commit():
+    db = get_db()
     db['conn'].commit()
+    db['pending'] = False
+    secs = float(psite.get_option("db_sqlite_checkpoint_secs", 300))
+    if time.monotonic() - get_pool()['checkpointed'] > secs:
+        wal_checkpoint()
 
 
 def postgres_table_exists(table):
-    db = get_db()
-    cur = db['cursor']
-
-    cur.execute("select 0"
-                " from information_schema.tables"
-                " where table_schema = 'public'"
-                "   and table_name = %s",
-                (table,))
+    query(*table_exists_query("postgres", table))
     return fetch() is not None
 
 
 def postgres_column_exists(table, column):
-    db = get_db()
-    cur = db['cursor']
-
-    cur.execute("select 0"
-                " from information_schema.columns"
-                " where table_schema = 'public'"
-                "   and table_name = %s"
-                "   and column_name = %s",
-                (table, column))
+    query("select 0"
+          " from information_schema.columns"
+          " where table_schema = 'public'"
+          "   and table_name = ?"
+          "   and column_name = ?",
+          (table, column))
     return fetch() is not None
 
 
 def postgres_commit():
     query("commit")
+    get_db()['pending'] = False
 
 
 def mysql_table_exists(table):
-    cfg = psite.get_cfg()
-    db = get_db()
-    cur = db['cursor']
-
-    cur.execute("select 0"
-                " from information_schema.tables"
-                " where table_schema = %s"
-                "   and table_name = %s",
-                (cfg['dbname'], table))
+    query(*table_exists_query("mysql", table))
     return fetch() is not None
 
 
 def mysql_column_exists(table, column):
     cfg = psite.get_cfg()
-    db = get_db()
-    cur = db['cursor']
-
-    cur.execute("select 0"
-                " from information_schema.columns"
-                " where table_schema = %s"
-                "   and table_name = %s"
-                "   and column_name = %s",
-                (cfg['dbname'], table, column))
+    query("select 0"
+          " from information_schema.columns"
+          " where table_schema = ?"
+          "   and table_name = ?"
+          "   and column_name = ?",
+          (cfg['dbname'], table, column))
     return fetch() is not None
 
 
 def mysql_commit():
     query("commit")
+    get_db()['pending'] = False
+
+
+backends = dict(
+    sqlite3=dict(connect=sqlite3_connect,
+                 ping=sqlite3_ping,
+                 errors=sqlite3_errors,
+                 all_errors=sqlite3_all_errors,
+                 table_exists=sqlite3_table_exists,
+                 column_exists=sqlite3_column_exists,
+                 commit=sqlite3_commit),
+    postgres=dict(connect=postgres_connect,
+                  ping=postgres_ping,
+                  errors=postgres_errors,
+                  all_errors=postgres_all_errors,
+                  table_exists=postgres_table_exists,
+                  column_exists=postgres_column_exists,
+                  commit=postgres_commit),
+    mysql=dict(connect=mysql_connect,
+               ping=mysql_ping,
+               errors=mysql_errors,
+               all_errors=mysql_all_errors,
+               table_exists=mysql_table_exists,
+               column_exists=mysql_column_exists,
+               commit=mysql_commit))
+
+
+token_patterns = dict(
+    # standard_conforming_strings: backslash is not an escape
+    postgres=re.compile(r"""
+        (?P<literal>'(?:[^']|'')*'
+                   |"(?:[^"]|"")*"
+                   |--[^\n]*
+                   |/\*.*?\*/
+                   |\$(?P<tag>\w*)\$.*?\$(?P=tag)\$)
+        |(?P<param>\?)
+        |(?P<text>[^'"?$/-]+|.)
+    """, re.S | re.X),
+    mysql=re.compile(r"""
+        (?P<literal>'(?:[^'\\]|''|\\.)*'
+                   |"(?:[^"\\]|""|\\.)*"
+                   |`[^`]*`
+                   |(?:--\s|\#)[^\n]*
+                   |/\*.*?\*/)
+        |(?P<param>\?)
+        |(?P<text>[^'"`?\#/-]+|.)
+    """, re.S | re.X),
+    sqlite3=re.compile(r"""
+        (?P<literal>'(?:[^']|'')*'
+                   |"(?:[^"]|"")*"
+                   |`[^`]*`
+                   |\[[^\]]*\]
+                   |--[^\n]*
+                   |/\*.*?\*/)
+        |(?P<param>\?)
+        |(?P<text>[^'"`\[?/-]+|.)
+    """, re.S | re.X))
+
+
+# split stmt into (kind, text) tokens, kind being literal
+# (quoted strings, identifiers and comments), param or text
+def tokenize(stmt, dialect):
+    tokens = []
+    for m in token_patterns[dialect].finditer(stmt):
+        kind = m.lastgroup
+        if kind == "text" and tokens and tokens[-1][0] == "text":
+            tokens[-1] = ("text", tokens[-1][1] + m.group())
+        else:
+            tokens.append((kind, m.group()))
+    return tokens
+
+
+# returns (stmt, nparams) with ? placeholders rewritten for style:
+# qmark leaves them alone, format uses %s, numeric uses $1, $2...
+@functools.lru_cache(maxsize=1024)
+def translate_stmt(stmt, dialect, style):
+    tokens = tokenize(stmt, dialect)
+    nparams = sum(1 for kind, text in tokens if kind == "param")
+    if style == "qmark" or nparams == 0:
+        return (stmt, nparams)
+
+    out = []
+    n = 0
+    for kind, text in tokens:
+        if kind == "param":
+            n += 1
+            if style == "format":
+                out.append("%s")
+            else:
+                out.append("${}".format(n))
+        elif style == "format":
+            out.append(text.replace("%", "%%"))
+        else:
+            out.append(text)
+    return ("".join(out), nparams)
 
 
-def query(stmt, args=()):
+styles = dict(sqlite3="qmark", postgres="format", mysql="format")
+
+
+def translate(stmt):
     db = get_db()
-    if db["db"] == "postgres" or db["db"] == "mysql":
-        stmt = re.sub("[?]", "%s", stmt)
-    return (db['cursor'].execute(stmt, args))
+    return translate_stmt(stmt, db['db'], styles[db['db']])
+
+
+# returns an execute statement for a server-side prepared
+# version of stmt, preparing it on this connection if needed
+def prepare(db, stmt, nparams):
+    name = db['prepared'].get(stmt)
+    if name is None:
+        name = "psite_{}".format(len(db['prepared']))
+        numeric, nparams = translate_stmt(stmt, db['db'], "numeric")
+        db['cursor'].execute("prepare {} as {}".format(name, numeric))
+        db['prepared'][stmt] = name
+    return "execute {} ({})".format(name, ", ".join(["%s"] * nparams))
+
+
+def execute(db, stmt, args):
+    xstmt, nparams = translate_stmt(stmt, db['db'], styles[db['db']])
+    if nparams == 0 and not args:
+        return db['cursor'].execute(xstmt)
+    if db['db'] == "postgres" and get_pool()['prepare']:
+        xstmt = prepare(db, stmt, nparams)
+    return db['cursor'].execute(xstmt, args)
+
+
+# functions called as hook(kind, stmt, secs, rows) after each query,
+# fetch and commit.  Empty unless something like dbstats is enabled,
+# so the only cost otherwise is the emptiness test.
+hooks = []
+
+
+def run_hooks(kind, stmt, secs, rows):
+    for hook in hooks:
+        hook(kind, stmt, secs, rows)
+
+
+def query(stmt, args=()):
+    if not hooks:
+        return run_query(stmt, args)
+    start = time.perf_counter()
+    result = run_query(stmt, args)
+    local.last['last_stmt'] = stmt
+    run_hooks("query", stmt, time.perf_counter() - start, None)
+    return result
+
+
+def run_query(stmt, args):
+    db = query_db(stmt)
+    local.last = db
+    if db['role'].startswith("replica:"):
+        return run_replica_query(db, stmt, args)
+    try:
+        result = execute(db, stmt, args)
+    except get_pool()['backend']['errors']():
+        # only retry on a fresh connection when the old one is really
+        # gone and nothing uncommitted would be lost with it
+        if db['pending']:
+            raise
+        try:
+            get_pool()['backend']['ping'](db['conn'])
+        except Exception:
+            db = reconnect(db)
+            local.last = db
+            result = execute(db, stmt, args)
+        else:
+            raise
+    if not is_read_stmt(stmt):
+        wrote(db)
+    return result
+
+
+# reads see this thread's writes: uncommitted ones by staying on the
+# connection, committed ones by avoiding replicas that may lag behind
+def wrote(db):
+    db['pending'] = True
+    txn = getattr(local, "txn", None)
+    if txn is not None:
+        txn['writes'] += 1
+    local.sticky_until = time.monotonic() + float(psite.get_option(
+        "db_replica_sticky_secs", 60))
+
+
+# a read on a replica that fails is counted against it and redone on
+# the primary, except inside read_transaction()
+def run_replica_query(db, stmt, args):
+    state = replica_state(replica_host(db['role']))
+    start = time.perf_counter()
+    try:
+        result = execute(db, stmt, args)
+    except get_pool()['backend']['errors']() as e:
+        replica_failed(db, e)
+        if getattr(local, "read_txn", None) is db:
+            local.read_txn = None
+            raise
+        db = get_db()
+        local.last = db
+        return execute(db, stmt, args)
+    replica_ok(state, time.perf_counter() - start)
+    return result
 
 
 def fetch():
-    db = get_db()
-    return db['cursor'].fetchone()
+    db = last_db()
+    r = db['cursor'].fetchone()
+    if hooks and r is not None:
+        run_hooks("fetch", db.get('last_stmt'), 0, 1)
+    return r
+
+
+def fetchall():
+    db = last_db()
+    rows = db['cursor'].fetchall()
+    if hooks and rows:
+        run_hooks("fetch", db.get('last_stmt'), 0, len(rows))
+    return rows
+
+
+def stream_cursor(db):
+    if db['db'] == "postgres":
+        # named cursors live on the server until the transaction ends
+        db['streams'] = db.get('streams', 0) + 1
+        # replicas are in autocommit mode, which only allows hold cursors
+        return db['conn'].cursor(name="psite_iter_{}".format(db['streams']),
+                                 withhold=db['conn'].autocommit)
+    elif db['db'] == "mysql":
+        import MySQLdb.cursors
+        return db['conn'].cursor(MySQLdb.cursors.SSCursor)
+    return db['conn'].cursor()
+
+
+@functools.lru_cache(maxsize=256)
+def namedtuple_row(columns):
+    return collections.namedtuple("Row", columns, rename=True)
+
+
+def row_factory(cur, row):
+    if row is None or row == "tuple":
+        return None
+    columns = tuple([d[0] for d in cur.description])
+    if row == "namedtuple":
+        return namedtuple_row(columns)._make
+    elif row == "dict":
+        return lambda r: dict(zip(columns, r))
+    raise ValueError("unknown row type {}".format(row))
+
+
+# yield the rows of stmt, holding at most batch of them in memory
+# at once.  row may be "namedtuple" or "dict" instead of plain tuples.
+# On mysql the connection can't run other statements until the
+# iteration finishes.
+def iter_query(stmt, args=(), batch=None, row=None):
+    if not hooks:
+        yield from run_iter_query(stmt, args, batch, row)
+        return
+    start = time.perf_counter()
+    rows = 0
+    try:
+        for r in run_iter_query(stmt, args, batch, row):
+            rows += 1
+            yield r
+    finally:
+        run_hooks("query", stmt, time.perf_counter() - start, rows)
+
+
+def run_iter_query(stmt, args, batch, row):
+    db = query_db(stmt)
+    batch = get_batch_size(batch)
+    xstmt, nparams = translate_stmt(stmt, db['db'], styles[db['db']])
+    cur = stream_cursor(db)
+    try:
+        if db['db'] == "postgres":
+            cur.itersize = batch
+        if nparams == 0 and not args:
+            cur.execute(xstmt)
+        else:
+            cur.execute(xstmt, args)
+        make = row_factory(cur, row)
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                return
+            if make is None:
+                yield from rows
+            else:
+                for r in rows:
+                    yield make(r)
+    finally:
+        cur.close()
 
 
 def commit():
+    txn = getattr(local, "txn", None)
+    if txn is None:
+        return commit_now()
+    # inside transaction(): only commit when a batch is due
+    if txn['every'] is None or txn['depth'] > 0:
+        return None
+    if txn['writes'] >= txn['every'] or \
+       time.monotonic() - txn['started'] >= txn['every_secs']:
+        commit_now()
+        publish_txn(txn)
+        txn['writes'] = 0
+        txn['started'] = time.monotonic()
+        db = get_db()
+        if db['db'] == "sqlite3":
+            db['cursor'].execute("begin")
+    return None
+
+
+def commit_now():
+    db = get_db()
+    if not hooks:
+        return db['commit']()
+    start = time.perf_counter()
+    result = db['commit']()
+    run_hooks("commit", None, time.perf_counter() - start, None)
+    return result
+
+
+# vars and sequence blocks written inside a transaction stay with it,
+# so other threads never see them uncommitted; once committed they go
+# to the shared caches.
+def publish_txn(txn):
+    for name, val in txn['vars'].items():
+        cache_var(name, val)
+    txn['vars'] = {}
+    with seq_lock:
+        for name, ids in txn['seqs'].items():
+            if ids[0] <= ids[1]:
+                add_block(name, ids)
+    txn['seqs'] = {}
+
+
+def txn_cached(txn):
+    return (dict(txn['vars']),
+            dict([(name, list(ids)) for name, ids in txn['seqs'].items()]))
+
+
+# commit() calls from helpers like setvar and get_seq inside the block
+# do nothing, and everything commits when the outermost block exits or
+# rolls back if it raises.  Nested blocks are savepoints.  With every
+# and/or every_ms set on the outermost block, commit() calls do commit
+# once that many writes or milliseconds have gone by, for bulk jobs;
+# a failure then only rolls back the current batch.
+@contextlib.contextmanager
+def transaction(every=None, every_ms=None):
+    db = get_db()
+    txn = getattr(local, "txn", None)
+    if txn is not None:
+        txn['depth'] += 1
+        name = "psite_sp_{}".format(txn['depth'])
+        db['cursor'].execute("savepoint {}".format(name))
+        cached = txn_cached(txn)
+        try:
+            yield db
+        except BaseException:
+            db['cursor'].execute("rollback to savepoint {}".format(name))
+            db['cursor'].execute("release savepoint {}".format(name))
+            txn['vars'], txn['seqs'] = cached
+            raise
+        else:
+            db['cursor'].execute("release savepoint {}".format(name))
+        finally:
+            txn['depth'] -= 1
+        return
+
+    if every is not None or every_ms is not None:
+        every = every or float("inf")
+        every_secs = every_ms / 1000 if every_ms is not None \
+            else float("inf")
+    else:
+        every_secs = None
+    local.txn = txn = dict(depth=0, writes=0, every=every,
+                           every_secs=every_secs, started=time.monotonic(),
+                           vars={}, seqs={})
+    # sqlite3 only begins implicitly before dml, so ddl and reads
+    # would escape the transaction
+    if db['db'] == "sqlite3" and not db['conn'].in_transaction:
+        db['cursor'].execute("begin")
+    try:
+        yield db
+    except BaseException:
+        local.txn = None
+        db['conn'].rollback()
+        db['pending'] = False
+        raise
+    local.txn = None
+    db['pending'] = True
+    commit_now()
+    publish_txn(txn)
+
+
+def batches(rows, batch):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, batch))
+        if not chunk:
+            return
+        yield chunk
+
+
+def get_batch_size(batch):
+    if batch is None:
+        batch = int(psite.get_option("db_batch_size", 1000))
+    return batch
+
+
+# run stmt once per row of args, committing once per batch
+def query_many(stmt, rows, batch=None):
+    db = get_db()
+    xstmt = translate(stmt)[0]
+    count = 0
+    for chunk in batches(rows, get_batch_size(batch)):
+        start = time.perf_counter()
+        if db['db'] == "postgres":
+            import psycopg2.extras
+            psycopg2.extras.execute_batch(db['cursor'], xstmt, chunk,
+                                          page_size=len(chunk))
+        else:
+            # MySQLdb folds an insert into one multi-row VALUES itself
+            db['cursor'].executemany(xstmt, chunk)
+        if hooks:
+            run_hooks("query", stmt, time.perf_counter() - start, len(chunk))
+        wrote(db)
+        commit()
+        count += len(chunk)
+    return count
+
+
+def copy_value(val):
+    if val is None:
+        return "\\N"
+    if isinstance(val, (bytes, bytearray, memoryview)):
+        # bytea hex format, its backslash escaped for copy
+        return "\\\\x" + bytes(val).hex()
+    val = str(val)
+    return (val.replace("\\", "\\\\")
+            .replace("\t", "\\t")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r"))
+
+
+def postgres_copy(table, columns, chunk):
+    import io
+    buf = io.StringIO()
+    for row in chunk:
+        buf.write("\t".join([copy_value(val) for val in row]))
+        buf.write("\n")
+    buf.seek(0)
+    stmt = "copy {} ({}) from stdin".format(table, ", ".join(columns))
+    get_db()['cursor'].copy_expert(stmt, buf)
+
+
+# insert rows (sequences ordered like columns) in batches,
+# using the fastest bulk path of the backend
+def bulk_insert(table, columns, rows, batch=None):
     db = get_db()
-    return db['commit']()
+    stmt = "insert into {} ({}) values ({})".format(
+        table, ", ".join(columns), ", ".join(["?"] * len(columns)))
+    xstmt = translate(stmt)[0]
+    count = 0
+    for chunk in batches(rows, get_batch_size(batch)):
+        start = time.perf_counter()
+        if db['db'] == "postgres":
+            postgres_copy(table, columns, chunk)
+        else:
+            db['cursor'].executemany(xstmt, chunk)
+        if hooks:
+            run_hooks("query", stmt, time.perf_counter() - start, len(chunk))
+        wrote(db)
+        commit()
+        count += len(chunk)
+    return count
+
+
+# name -> (val, expires).  Entries are dropped when vars_version
+# changes, and in any case vars_cache_ttl seconds after caching, for
+# writes that don't bump it (manual sql, older php)
+vars_cache = collections.OrderedDict()
+vars_lock = threading.Lock()
+vars_state = dict(checked=None, version=None, versioned=None)
+
+
+def vars_versioned():
+    if vars_state['versioned'] is None:
+        vars_state['versioned'] = table_exists("vars_version")
+    return vars_state['versioned']
+
+
+# (table, column) -> whether upserts keyed on column can be used
+unique_keys = {}
+
+
+def has_unique_key(table, column):
+    key = (table, column)
+    if key not in unique_keys:
+        with primary_reads() as db:
+            query(*unique_key_query(db['db'], table, column))
+            unique_keys[key] = fetch() is not None
+    return unique_keys[key]
+
+
+# for tables made before mkschema added the unique index an upsert
+# needs: update, and insert if no row matched.  Not safe against a
+# concurrent insert of the same key, which is what the index is for.
+def update_or_insert(table, key, keyval, values):
+    query("update {} set {} where {} = ?".format(
+        table, ", ".join(["{} = ?".format(col) for col in values]), key),
+        tuple(values.values()) + (keyval,))
+    if get_db()['cursor'].rowcount > 0:
+        return
+    # mysql counts changed rows, not matched ones
+    with primary_reads():
+        query("select 0 from {} where {} = ?".format(table, key), (keyval,))
+        if fetch() is not None:
+            return
+    query("insert into {} ({}, {}) values (?, {})".format(
+        table, key, ", ".join(values), ", ".join(["?"] * len(values))),
+        (keyval,) + tuple(values.values()))
+
+
+# drop cached vars if another process bumped vars_version; the check
+# runs at most once per vars_cache_ttl seconds
+def check_vars_version():
+    ttl = float(psite.get_option("vars_cache_ttl", 1))
+    now = time.monotonic()
+    if vars_state['checked'] is not None and now - vars_state['checked'] < ttl:
+        return
+    if not vars_versioned():
+        # schema predates vars_version: entries just expire after the ttl
+        version = now
+    else:
+        query("select version from vars_version")
+        r = fetch()
+        version = 0 if r is None else r[0]
+    with vars_lock:
+        if version != vars_state['version']:
+            vars_cache.clear()
+        vars_state['checked'] = now
+        vars_state['version'] = version
+
+
+def cache_var(name, val):
+    expires = time.monotonic() + float(psite.get_option("vars_cache_ttl", 1))
+    with vars_lock:
+        vars_cache[name] = (val, expires)
+        vars_cache.move_to_end(name)
+        while len(vars_cache) > int(psite.get_option("vars_cache_max",
+                                                     1000)):
+            vars_cache.popitem(last=False)
+
+
+# (val,) if name is cached and fresh, else None
+def cached_var(name):
+    with vars_lock:
+        entry = vars_cache.get(name)
+        if entry is None:
+            return None
+        if time.monotonic() >= entry[1]:
+            del vars_cache[name]
+            return None
+        vars_cache.move_to_end(name)
+        return entry[:1]
 
 
 def getvar(name):
+    txn = getattr(local, "txn", None)
+    if txn is not None and name in txn['vars']:
+        return txn['vars'][name]
+    check_vars_version()
+    entry = cached_var(name)
+    if entry is not None:
+        return entry[0]
+
     query("select val from vars where var = ?", (name,))
     r = fetch()
-    if r is None:
-        return ""
-    return r[0]
+    val = "" if r is None else r[0]
+    if txn is not None:
+        # may be uncommitted
+        txn['vars'][name] = val
+    else:
+        cache_var(name, val)
+    return val
+
+
+upserts = dict(
+    sqlite3="insert or replace into vars (var, val) values (?, ?)",
+    postgres=("insert into vars (var, val) values (?, ?)"
+              " on conflict (var) do update set val = excluded.val"),
+    mysql=("insert into vars (var, val) values (?, ?)"
+           " on duplicate key update val = values(val)"))
 
 
 def setvar(name, val):
-    query("select val from vars where var = ?", (name,))
-    if fetch() is None:
-        query("insert into vars (var, val) values (?, ?)", (name, val))
+    db = get_db()
+    # the upsert needs the unique vars_var index made by mkschema
+    if has_unique_key("vars", "var"):
+        query(upserts[db['db']], (name, val))
     else:
-        query("update vars set val = ? where var = ?", (val, name))
+        update_or_insert("vars", "var", name, dict(val=val))
+    if vars_versioned():
+        query("update vars_version set version = version + 1")
+        if db['cursor'].rowcount == 0:
+            query("insert into vars_version (version) values (1)")
+    txn = getattr(local, "txn", None)
+    if txn is not None:
+        txn['vars'][name] = val
+        commit()
+        return
     commit()
+    cache_var(name, val)
 
 
 def table_exists(table):
@@ -229,133 +1416,93 @@ def column_exists(table, column):
     return db['column_exists'](table, column)
 
 
-def make_column(table, column, coltype):
-    db = get_db()
-    if not table_exists(table):
-        stmt = "create table {} ({} {})".format(table, column, coltype)
-        print(stmt)
-        db['cursor'].execute(stmt)
-    elif not column_exists(table, column):
-        stmt = "alter table {} add {} {}".format(table, column, coltype)
-        if db['db'] == "mysql" and coltype == "timestamp":
-            stmt += " null"
-        print(stmt)
-        db['cursor'].execute(stmt)
-
-
-def get_seq():
-    query("select lastval from seq")
-    result = fetch()
-    if result is None:
-        curval = 100
-        query("insert into seq (lastval) values (?)", (curval,))
-        commit()
-    else:
-        curval = result[0] + 1
-        query("update seq set lastval = ?", (curval,))
-        commit()
-        return curval
-
-
-def mkschema():
-    filename = "schema"
-    with open(filename) as f:
-        table = None
-        linenum = 0
-        for line in f:
-            linenum = linenum + 1
-            line = re.sub(re.compile("#.*"), "", line).strip()
-            words = re.split("\\s+", line)
-            if len(words) == 0:
-                continue
-            if words[0] == "table":
-                if len(words) != 2:
-                    raise ValueError("{}:{}: wrong number of args"
-                                     .format(filename, linenum))
-                table = words[1]
-            elif words[0] == "col":
-                if len(words) != 3:
-                    raise ValueError("{}:{}: wrong number of args"
-                                     .format(filename, linenum))
-                column = words[1]
-                typename = words[2]
-                make_column(table, column, typename)
-                commit()
-
-
-def do_backup():
-    cfg = psite.get_cfg()
-
-    backups_dir = "{}/backups".format(cfg['aux_dir'])
-    if not os.path.exists(backups_dir):
-        os.mkdir(backups_dir, 0o775)
+seq_blocks = {}
+seq_lock = threading.Lock()
 
-    ts = time.strftime("%Y%m%dT%H%M%S")
-    basename = "{}-{}.sql".format(cfg['siteid'], ts)
-    gzname = "{}.gz".format(basename)
-
-    if cfg["db"] == "mysql":
-        cmd = []
-        cmd.append("mysqldump")
-        if psite.get_option("db_host") is not None:
-            cmd.append("--login-path={}".format(cfg['siteid']))
+seq_inserts = dict(
+    sqlite3="insert or ignore into seqs (name, lastval) values (?, ?)",
+    postgres=("insert into seqs (name, lastval) values (?, ?)"
+              " on conflict (name) do nothing"),
+    mysql="insert ignore into seqs (name, lastval) values (?, ?)")
 
-        cmd.append("--single-transaction")
-        cmd.append("--add-drop-table")
-        cmd.append("--result-file")
-        cmd.append("{}/{}".format(backups_dir, basename))
-        cmd.append(cfg['dbname'])
 
-        print(" ".join(cmd))
-        if subprocess.call(cmd) != 0:
-            print("db dump error")
-            sys.exit(1)
-
-        cmd = "gzip --force {}/{}".format(backups_dir, basename)
-        if os.system(cmd) != 0:
-            print("db dump error during compression")
-            sys.exit(1)
-    elif cfg["db"] == "postgres":
-        cmd = ("pg_dump"
-               " --dbname={}"
-               " --file={}/{}"
-               " --no-owner"
-               " --no-acl"
-               " --compress=6"
-               " --lock-wait-timeout=60000").format(
-                   cfg['dbname'],
-                   backups_dir,
-                   gzname)
-        if os.system(cmd) != 0:
-            print("db dump error")
-            sys.exit(1)
-
-    latest = "{}/latest.gz".format(backups_dir)
-    if os.path.exists(latest):
-        os.remove(latest)
-
-    os.symlink(gzname, latest)
-    print(latest)
-
-
-def restore():
-    cfg = psite.get_cfg()
+# reserve count ids for the named sequence in one atomic step and
+# return the last one.  postgres does it in a single statement; on
+# sqlite3 and mysql the update takes the write lock before the read.
+def reserve_seq(name, count):
+    db = get_db()
+    for attempt in range(2):
+        if db['db'] == "postgres":
+            query("update seqs set lastval = lastval + ?"
+                  " where name = ?"
+                  " returning lastval",
+                  (count, name))
+        else:
+            query("update seqs set lastval = lastval + ? where name = ?",
+                  (count, name))
+            query("select lastval from seqs where name = ?", (name,))
+        r = fetch()
+        if r is not None:
+            break
+        query(seq_inserts[db['db']], (name, 99))
+    commit()
+    return r[0]
 
-    print("restore")
-    if len(sys.argv) < 3:
-        print("usage: psite restore filename")
-        sys.exit(1)
-    filename = sys.argv[2]
 
-    auth = ""
-    if psite.get_option("db_host") is not None:
-        auth = " --login-path={}".format(cfg['siteid'])
+# blocks reserved by threads that raced for the same sequence, used up
+# after the current one
+seq_spares = {}
 
-    cmd = "mysql {} -Nrse 'create database `{}`'".format(auth, cfg['dbname'])
-    print(cmd)
 
-    cmd = "gunzip < {} | mysql {} {}".format(filename, auth, cfg['dbname'])
-    print(cmd)
+def add_block(name, ids):
+    have = seq_blocks.get(name)
+    if have is None or have[0] > have[1]:
+        seq_blocks[name] = ids
+    else:
+        seq_spares.setdefault(name, []).append(ids)
+
+
+def take_shared(name):
+    val = take_seq(seq_blocks, name)
+    while val is None and seq_spares.get(name):
+        seq_blocks[name] = seq_spares[name].pop()
+        val = take_seq(seq_blocks, name)
+    return val
+
+
+def take_seq(blocks, name):
+    ids = blocks.get(name)
+    if ids is None or ids[0] > ids[1]:
+        return None
+    val = ids[0]
+    ids[0] += 1
+    return val
+
+
+# ids come from blocks of seq_block values reserved at once; ids left
+# in a block when the process exits are never handed out.  Inside
+# transaction() a new block is only shared after it commits.
+def get_seq(name="default", block=None):
+    if block is None:
+        block = int(psite.get_option("seq_block", 1))
+    txn = getattr(local, "txn", None)
+    with seq_lock:
+        val = take_shared(name)
+        if val is not None:
+            return val
+    if txn is None:
+        # not under seq_lock: the thread may hold the db's write lock,
+        # which another thread in reserve_seq would be waiting for
+        last = reserve_seq(name, block)
+        with seq_lock:
+            add_block(name, [last - block + 1, last])
+            return take_shared(name)
+    val = take_seq(txn['seqs'], name)
+    if val is None:
+        last = reserve_seq(name, block)
+        txn['seqs'][name] = [last - block + 1, last]
+        val = take_seq(txn['seqs'], name)
+    return val
 
 
 def cmd_sql():
@@ -0,0 +1,179 @@
+import os
+import re
+import sys
+import time
+import json
+import atexit
+import threading
+import functools
+
+import psite
+import db
+
+# per-statement timing collected through db.hooks.  Turned on by the
+# db_stats option, or db_slow_ms, which also logs statements slower
+# than that many milliseconds to aux_dir/db-slow.log.  Totals are
+# merged into aux_dir/db-stats.json at exit or by dump().
+
+stats = {}
+stats_lock = threading.Lock()
+state = dict(enabled=False, slow_secs=None, to_file=False)
+
+# bucket i counts calls taking less than 2**i microseconds (and at
+# least 2**(i-1))
+nbuckets = 40
+
+literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+in_list_re = re.compile(r"\bin\s*\(\s*\?(?:\s*,\s*\?)+\s*\)",
+                        re.IGNORECASE)
+space_re = re.compile(r"\s+")
+
+
+# statements differing only in literals and the length of in (...)
+# lists share an entry
+@functools.lru_cache(maxsize=1024)
+def normalize(stmt):
+    if stmt is None:
+        return "?"
+    stmt = literal_re.sub("?", stmt)
+    stmt = in_list_re.sub("in (?, ...)", stmt)
+    return space_re.sub(" ", stmt).strip()
+
+
+def new_entry():
+    return dict(count=0, secs=0.0, max=0.0, rows=0,
+                buckets=[0] * nbuckets)
+
+
+def record(kind, stmt, secs, rows):
+    key = "commit" if kind == "commit" else normalize(stmt)
+    with stats_lock:
+        entry = stats.get(key)
+        if entry is None:
+            entry = stats[key] = new_entry()
+        if kind == "fetch":
+            entry['rows'] += rows
+            return
+        entry['count'] += 1
+        entry['secs'] += secs
+        if secs > entry['max']:
+            entry['max'] = secs
+        entry['buckets'][min(int(secs * 1e6).bit_length(),
+                             nbuckets - 1)] += 1
+        if rows:
+            entry['rows'] += rows
+    if state['slow_secs'] is not None and secs >= state['slow_secs']:
+        log_slow(stmt, secs)
+
+
+def log_slow(stmt, secs):
+    cfg = psite.get_cfg()
+    line = "{} {} {:.1f} ms {}\n".format(
+        time.strftime("%Y-%m-%d %H:%M:%S"), os.getpid(), secs * 1000,
+        space_re.sub(" ", stmt or "commit").strip())
+    with open("{}/db-slow.log".format(cfg['aux_dir']), "a") as f:
+        f.write(line)
+
+
+# to_file=False only collects, for callers like psite profile that
+# report the stats themselves
+def enable(to_file=True):
+    if not state['enabled']:
+        state['enabled'] = True
+        slow_ms = psite.get_option("db_slow_ms")
+        if slow_ms is not None:
+            state['slow_secs'] = float(slow_ms) / 1000
+        db.hooks.append(record)
+    if to_file and not state['to_file']:
+        state['to_file'] = True
+        atexit.register(dump)
+
+
+def stats_file():
+    return "{}/db-stats.json".format(psite.get_cfg()['aux_dir'])
+
+
+def merge(total, entries):
+    for key, entry in entries.items():
+        old = total.get(key)
+        if old is None:
+            total[key] = entry
+            continue
+        old['count'] += entry['count']
+        old['secs'] += entry['secs']
+        old['max'] = max(old['max'], entry['max'])
+        old['rows'] += entry['rows']
+        old['buckets'] = [a + b for a, b in zip(old['buckets'],
+                                                entry['buckets'])]
+
+
+# move what this process has collected into db-stats.json
+def dump():
+    with stats_lock:
+        entries = dict(stats)
+        stats.clear()
+    if not entries:
+        return
+    psite.update_json(stats_file(), lambda total: merge(total, entries),
+                      pretty=False, fast=True)
+
+
+# upper bound of the bucket holding the pct'th percentile call
+def percentile(buckets, pct):
+    target = sum(buckets) * pct / 100
+    seen = 0
+    for i, n in enumerate(buckets):
+        seen += n
+        if n and seen >= target:
+            return (1 << i) / 1e6
+    return 0
+
+
+def summarize(entries):
+    rows = []
+    for key, entry in entries.items():
+        count = entry['count']
+        rows.append(dict(stmt=key,
+                         count=count,
+                         total_ms=entry['secs'] * 1000,
+                         avg_ms=entry['secs'] * 1000 / count if count else 0,
+                         p50_ms=percentile(entry['buckets'], 50) * 1000,
+                         p95_ms=percentile(entry['buckets'], 95) * 1000,
+                         p99_ms=percentile(entry['buckets'], 99) * 1000,
+                         max_ms=entry['max'] * 1000,
+                         rows=entry['rows']))
+    rows.sort(key=lambda r: r['total_ms'], reverse=True)
+    return rows
+
+
+def print_summary(rows):
+    print("{:>8} {:>10} {:>8} {:>8} {:>8} {:>8} {:>8}  {}".format(
+        "count", "total ms", "avg ms", "p50<", "p95<", "p99<", "rows",
+        "statement"))
+    for r in rows:
+        print("{:8d} {:10.1f} {:8.2f} {:8.2f} {:8.2f} {:8.2f} {:8d}  {}"
+              .format(r['count'], r['total_ms'], r['avg_ms'], r['p50_ms'],
+                      r['p95_ms'], r['p99_ms'], r['rows'], r['stmt']))
+
+
+def cmd_db_stats():
+    args = sys.argv[2:]
+    as_json = "--json" in args
+    if "--reset" in args:
+        try:
+            os.remove(stats_file())
+        except(FileNotFoundError):
+            pass
+        return
+    top = None
+    if "--top" in args:
+        top = int(args[args.index("--top") + 1])
+
+    rows = summarize(psite.read_json(stats_file(), {}, fast=True))[:top]
+    if as_json:
+        print(json.dumps(rows, indent=2))
+    elif not rows:
+        print("no stats in {}; set the db_stats option".format(
+            stats_file()))
+    else:
+        print_summary(rows)
@@ -0,0 +1,163 @@
+import os
+import sys
+import glob
+import time
+import signal
+import threading
+import subprocess
+import concurrent.futures
+
+# commands that hammer the disk or network; their starts are spread out
+heavy_cmds = ["backup", "do-cron", "restore", "s3-sync", "get-latest"]
+
+
+def usage():
+    print("usage: psite multi [-j jobs] [-t timeout] [--stagger secs]"
+          " [--heavy n] [--logs dir] cmd [args...] -- site_dir|glob...")
+    sys.exit(1)
+
+
+def parse_args(argv):
+    opts = dict(jobs=4, timeout=3600, stagger=10, heavy=2, logs=None)
+    flags = {"-j": "jobs", "-t": "timeout", "--stagger": "stagger",
+             "--heavy": "heavy", "--logs": "logs"}
+    while argv and argv[0] in flags:
+        if len(argv) < 2:
+            usage()
+        name = flags[argv[0]]
+        opts[name] = argv[1] if name == "logs" else float(argv[1])
+        argv = argv[2:]
+
+    if "--" in argv:
+        i = argv.index("--")
+        cmd, patterns = argv[:i], argv[i + 1:]
+    else:
+        cmd, patterns = argv[:1], argv[1:]
+    if not cmd or not patterns:
+        usage()
+
+    dirs = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if os.path.isfile(os.path.join(path, "cfg.json")):
+                dirs.append(os.path.abspath(path))
+            else:
+                print("skipping {}: no cfg.json".format(path))
+    return (opts, cmd, dirs)
+
+
+# each site's psite runs in its own process group, so that on timeout
+# the mysqldump, pg_dump or aws it started is killed along with it
+running = set()
+running_lock = threading.Lock()
+
+
+def kill_group(proc, grace=10):
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            proc.wait(grace)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+
+
+def site_name(site_dir):
+    return os.path.basename(site_dir.rstrip("/"))
+
+
+def run_site(site_dir, cmd, opts, log_dir, throttle):
+    psite_cmd = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "psite")
+    log = os.path.join(log_dir, "{}.log".format(site_name(site_dir)))
+    heavy = cmd[0] in heavy_cmds
+
+    if heavy:
+        throttle['sem'].acquire()
+        with throttle['lock']:
+            wait = throttle['next'] - time.monotonic()
+            throttle['next'] = max(throttle['next'], time.monotonic()) + \
+                opts['stagger']
+        if wait > 0:
+            time.sleep(wait)
+
+    start = time.monotonic()
+    try:
+        with open(log, "w") as outf:
+            proc = subprocess.Popen([sys.executable, psite_cmd] + cmd,
+                                    cwd=site_dir, stdin=subprocess.DEVNULL,
+                                    stdout=outf, stderr=subprocess.STDOUT,
+                                    start_new_session=True)
+        with running_lock:
+            running.add(proc)
+        try:
+            proc.wait(opts['timeout'])
+            status = "ok" if proc.returncode == 0 else \
+                "exit {}".format(proc.returncode)
+        except subprocess.TimeoutExpired:
+            kill_group(proc)
+            status = "timeout"
+        finally:
+            with running_lock:
+                running.discard(proc)
+    except OSError as e:
+        status = "error {}".format(e)
+    finally:
+        if heavy:
+            throttle['sem'].release()
+    return (status, time.monotonic() - start, log)
+
+
+def cmd_multi():
+    opts, cmd, dirs = parse_args(sys.argv[2:])
+
+    log_dir = opts['logs']
+    if log_dir is None:
+        log_dir = os.path.join("psite-multi-logs", "{}-{}".format(
+            time.strftime("%Y%m%dT%H%M%S"), cmd[0]))
+    os.makedirs(log_dir, exist_ok=True)
+
+    throttle = dict(sem=threading.Semaphore(int(opts['heavy'])),
+                    lock=threading.Lock(),
+                    next=time.monotonic())
+
+    results = {}
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(int(opts['jobs'])) as pool:
+        futures = dict([(pool.submit(run_site, site_dir, cmd, opts,
+                                     log_dir, throttle), site_dir)
+                        for site_dir in dirs])
+        try:
+            for f in concurrent.futures.as_completed(futures):
+                site_dir = futures[f]
+                results[site_dir] = f.result()
+                print("{}: {}".format(site_name(site_dir),
+                                      results[site_dir][0]))
+        except BaseException:
+            # the sites' own sessions don't get our ^C
+            for f in futures:
+                f.cancel()
+            with running_lock:
+                procs = list(running)
+            for proc in procs:
+                kill_group(proc, grace=2)
+            raise
+
+    width = max([len(site_name(d)) for d in dirs] + [4])
+    print("")
+    print("{:{}}  {:>9}  {:10}  {}".format("site", width, "secs",
+                                           "status", "log"))
+    failed = 0
+    for site_dir in dirs:
+        status, secs, log = results[site_dir]
+        if status != "ok":
+            failed += 1
+        print("{:{}}  {:9.1f}  {:10}  {}".format(site_name(site_dir), width,
+                                                 secs, status, log))
+    print("{} sites, {} failed, {:.1f} secs".format(
+        len(dirs), failed, time.monotonic() - start))
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,277 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+import collections
+
+import psite
+
+# psite profile runs another psite command under cProfile, with a
+# sampling thread for collapsed stacks (flamegraph.pl, speedscope),
+# phase() timings, optional tracemalloc snapshots and the db statements
+# it ran.  Each run goes to aux_dir/profiles/<time>-<cmd>/ and
+# "psite profile --list" compares the runs kept there.
+#
+# (named prof rather than profile, which cProfile imports)
+
+# phase timings of the run being profiled; None when not profiling
+phases = None
+started = None
+
+
+# time a step of a command; costs one check when not profiling
+@contextlib.contextmanager
+def phase(name):
+    if phases is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        phases.append(dict(name=name, start=start - started,
+                           secs=end - start))
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "{} ({}:{})".format(code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+
+# count the stacks of every other thread each interval seconds
+def sample_stacks(interval, stacks, stop):
+    me = threading.get_ident()
+    while not stop.wait(interval):
+        names = dict([(t.ident, t.name) for t in threading.enumerate()])
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, "thread-{}".format(ident)))
+            stacks[";".join(reversed(stack))] += 1
+
+
+def profiles_dir():
+    cfg = psite.get_cfg()
+    return "{}/profiles".format(cfg.get('aux_dir', "."))
+
+
+def write_text(filename, text):
+    with open(filename, "w") as outf:
+        outf.write(text)
+
+
+def write_pstats(out_dir, prof):
+    import io
+    import pstats
+
+    prof.dump_stats("{}/profile.pstats".format(out_dir))
+    buf = io.StringIO()
+    st = pstats.Stats(prof, stream=buf)
+    st.strip_dirs()
+    st.sort_stats("cumulative").print_stats(60)
+    st.sort_stats("tottime").print_stats(30)
+    write_text("{}/profile.txt".format(out_dir), buf.getvalue())
+    return st
+
+
+def write_memory(out_dir, snapshot, peak):
+    lines = ["peak {:.1f} MB".format(peak / 1e6), ""]
+    for stat in snapshot.statistics("lineno")[:30]:
+        lines.append(str(stat))
+    lines.append("")
+    for stat in snapshot.statistics("traceback")[:5]:
+        lines.append("{} blocks, {:.1f} KB".format(stat.count,
+                                                   stat.size / 1e3))
+        lines.extend(stat.traceback.format())
+        lines.append("")
+    write_text("{}/memory.txt".format(out_dir), "\n".join(lines))
+
+
+def find_cmd(cmds, name):
+    for elt in cmds:
+        if elt[0] == name and name != "profile":
+            fn = elt[1]
+            if isinstance(fn, str):
+                fn = getattr(psite, fn)
+            return fn
+    return None
+
+
+def usage():
+    print("usage: psite profile [--mem] [--interval ms] cmd [args...]")
+    print("       psite profile --list [cmd]")
+    sys.exit(1)
+
+
+def cmd_profile(cmds):
+    global phases, started
+
+    args = sys.argv[2:]
+    if args[:1] == ["--list"]:
+        list_profiles(args[1] if len(args) > 1 else None)
+        return
+
+    mem = False
+    interval = float(psite.get_option("profile_interval_ms", 5)) / 1000
+    while args and args[0].startswith("--"):
+        if args[0] == "--mem":
+            mem = True
+            args = args[1:]
+        elif args[0] == "--interval" and len(args) >= 2:
+            interval = float(args[1]) / 1000
+            args = args[2:]
+        else:
+            usage()
+    if not args:
+        usage()
+    name = args[0]
+    fn = find_cmd(cmds, name)
+    if fn is None:
+        print("profile: unknown command {}".format(name))
+        sys.exit(1)
+
+    import cProfile
+    import dbstats
+
+    sys.argv = [sys.argv[0]] + args
+    out_dir = "{}/{}-{}-{}".format(profiles_dir(),
+                                   time.strftime("%Y%m%dT%H%M%S"),
+                                   name, os.getpid())
+
+    # the run's statements are reported here; only db_stats decides
+    # whether they are also merged into db-stats.json
+    dbstats.enable(to_file=False)
+    with dbstats.stats_lock:
+        db_before = json.loads(json.dumps(dbstats.stats))
+    if mem:
+        import tracemalloc
+        tracemalloc.start(25)
+
+    stacks = collections.Counter()
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_stacks,
+                               args=(interval, stacks, stop),
+                               name="psite-profile", daemon=True)
+    phases = []
+    status = 0
+    prof = cProfile.Profile()
+    start_time = time.time()
+    cpu = time.process_time()
+    started = time.perf_counter()
+    sampler.start()
+    prof.enable()
+    try:
+        fn()
+    except SystemExit as e:
+        status = e.code or 0
+    except BaseException as e:
+        status = "{}: {}".format(type(e).__name__, e)
+        raise
+    finally:
+        prof.disable()
+        wall = time.perf_counter() - started
+        cpu = time.process_time() - cpu
+        stop.set()
+        sampler.join()
+        peak = None
+        if mem:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        with dbstats.stats_lock:
+            db_after = json.loads(json.dumps(dbstats.stats))
+        run_phases = phases
+        phases = None
+
+        os.makedirs(out_dir, exist_ok=True)
+        st = write_pstats(out_dir, prof)
+        write_text("{}/stacks.collapsed".format(out_dir),
+                   "".join(["{} {}\n".format(stack, count)
+                            for stack, count in sorted(stacks.items())]))
+        if mem:
+            write_memory(out_dir, snapshot, peak)
+        db_rows = dbstats.summarize(run_stats(db_before, db_after))
+        psite.write_json("{}/db-stats.json".format(out_dir), db_rows)
+        summary = dict(cmd=name,
+                       argv=args,
+                       start=time.strftime("%Y-%m-%dT%H:%M:%S",
+                                           time.localtime(start_time)),
+                       status=status,
+                       wall_secs=wall,
+                       cpu_secs=cpu,
+                       calls=st.total_calls,
+                       samples=sum(stacks.values()),
+                       peak_mem=peak,
+                       queries=sum([r['count'] for r in db_rows
+                                    if r['stmt'] != "commit"]),
+                       db_ms=sum([r['total_ms'] for r in db_rows]),
+                       phases=run_phases)
+        psite.write_json("{}/summary.json".format(out_dir), summary)
+        report(out_dir, summary, db_rows)
+
+    if status:
+        sys.exit(status)
+
+
+# what the run added to dbstats.stats
+def run_stats(before, after):
+    entries = {}
+    for key, entry in after.items():
+        old = before.get(key)
+        if old is not None:
+            entry = dict(count=entry['count'] - old['count'],
+                         secs=entry['secs'] - old['secs'],
+                         max=entry['max'],
+                         rows=entry['rows'] - old['rows'],
+                         buckets=[a - b for a, b in zip(entry['buckets'],
+                                                        old['buckets'])])
+        if entry['count'] or entry['rows']:
+            entries[key] = entry
+    return entries
+
+
+def report(out_dir, summary, db_rows):
+    # stderr, so the command's own output can still be piped
+    f = sys.stderr
+    f.write("\nprofile: {}\n".format(out_dir))
+    f.write("  wall {:.3f}s cpu {:.3f}s".format(summary['wall_secs'],
+                                                summary['cpu_secs']))
+    if summary['peak_mem'] is not None:
+        f.write(" peak {:.1f} MB".format(summary['peak_mem'] / 1e6))
+    f.write(" {} queries {:.1f} ms\n".format(summary['queries'],
+                                             summary['db_ms']))
+    for p in summary['phases']:
+        f.write("  {:8.3f}s {:8.3f}s  {}\n".format(p['start'], p['secs'],
+                                                   p['name']))
+    for r in db_rows[:5]:
+        f.write("  {:6d} {:9.1f} ms  {}\n".format(r['count'], r['total_ms'],
+                                                  r['stmt'][:70]))
+
+
+def list_profiles(name=None):
+    top = profiles_dir()
+    try:
+        runs = sorted(os.listdir(top))
+    except(FileNotFoundError):
+        runs = []
+    print("{:<32} {:>9} {:>9} {:>9} {:>8} {:>6}  {}".format(
+        "run", "wall s", "cpu s", "peak MB", "queries", "status", "args"))
+    for run in runs:
+        summary = psite.read_json("{}/{}/summary.json".format(top, run), {})
+        if not summary or (name is not None and summary['cmd'] != name):
+            continue
+        peak = summary.get('peak_mem')
+        print("{:<32} {:9.3f} {:9.3f} {:>9} {:8d} {:>6}  {}".format(
+            run, summary['wall_secs'], summary['cpu_secs'],
+            "-" if peak is None else "{:.1f}".format(peak / 1e6),
+            summary['queries'], str(summary['status'])[:6],
+            " ".join(summary['argv'])))
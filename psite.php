@@ -299,7 +299,7 @@ function psite_session_write ($session_id, $session) {
 }
 
 function psite_session_destroy ($session_id) {
-	query ("delete from session where session_id = ?", $session_id);
+	query ("delete from sessions where session_id = ?", $session_id);
 	do_commits ();
     return (TRUE);
 }
@@ -366,6 +366,33 @@ function getvar ($name) {
     return ("");
 }
 
+/* whether the table python's vars cache checks for changes exists */
+function psite_vars_versioned () {
+    global $options;
+    static $versioned = NULL;
+
+    if ($versioned === NULL) {
+        if ($options['db'] == "sqlite3") {
+            $q = query ("select 0"
+                ." from sqlite_master"
+                ." where type = 'table'"
+                ."   and name = 'vars_version'");
+        } else if ($options['db'] == "postgres") {
+            $q = query ("select 0"
+                ." from information_schema.tables"
+                ." where table_schema = 'public'"
+                ."   and table_name = 'vars_version'");
+        } else {
+            $q = query ("select 0"
+                ." from information_schema.tables"
+                ." where table_schema = database()"
+                ."   and table_name = 'vars_version'");
+        }
+        $versioned = fetch ($q) != NULL;
+    }
+    return ($versioned);
+}
+
 function setvar ($name, $val) {
     $q = query ("select 0"
         ." from vars"
@@ -378,21 +405,32 @@ function setvar ($name, $val) {
         query ("update vars set val = ? where var = ?",
                array ($val, $name));
     }
+
+    /* same transaction: tells python processes to drop cached vars */
+    if (psite_vars_versioned ()) {
+        $q = query ("update vars_version set version = version + 1");
+        if ($q->q->rowCount () == 0)
+            query ("insert into vars_version (version) values (1)");
+    }
 }
 
-function get_seq ($db = NULL) {
+function get_seq ($db = NULL, $name = "default") {
+	/* the update takes the write lock before the read */
+	query_db ($db,
+		  "update seqs set lastval = lastval + 1"
+		  ." where name = ?",
+		  $name);
 	$q = query_db ($db,
 		       "select lastval"
-		       ." from seq"
-		       ." limit 1");
+		       ." from seqs"
+		       ." where name = ?",
+		       $name);
 	if (($r = fetch ($q)) == NULL) {
 		$newval = 100;
-		query_db ($db, "insert into seq (lastval) values (?)",
-			  $newval);
+		query_db ($db, "insert into seqs (name, lastval) values (?, ?)",
+			  array ($name, $newval));
 	} else {
-		$newval = 1 + intval ($r->lastval);
-		query_db ($db, "update seq set lastval = ?",
-			  $newval);
+		$newval = intval ($r->lastval);
 	}
 	return ($newval);
 }
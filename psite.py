@@ -1,30 +1,166 @@
 import json
 import os
-import socket
-from html.parser import HTMLParser
+import sys
+import time
+import importlib
 
-from install import install, tunnel_install, edit_credentials  # noqa: F401
-from db import (mkschema, query, fetch, get_seq, commit,  # noqa: F401
-                getvar, setvar, do_backup, restore, cmd_sql)
+# submodules load on first use so each command only pays for what it
+# touches; "from psite import x" and psite.x both work
+lazy = dict(
+    install="install", tunnel_install="install", edit_credentials="install",
+    query="db", fetch="db", get_seq="db", commit="db", getvar="db",
+    setvar="db", cmd_sql="db", query_many="db", bulk_insert="db",
+    iter_query="db", wal_checkpoint="db", end_request="db",
+    read_transaction="db", transaction="db",
+    s3_setup="aws", s3_sync="aws", s3_get_latest="aws",
+    mkschema="schema",
+    do_backup="backup", restore="backup",
+    cmd_bench="bench",
+    cmd_multi="multi",
+    cmd_profile="prof", phase="prof",
+    cmd_db_stats="dbstats",
+    cached_query="qcache",
+    read_session="session", write_session="session",
+    destroy_session="session", get_session="session",
+    save_session="session", gc_sessions="session",
+    MLStripper="striptags", strip_tags="striptags",
+    strip_tags_many="striptags", iter_strip_tags="striptags",
+    strip_tags_file="striptags")
 
-from aws import (s3_setup, s3_sync, s3_get_latest)  # noqa: F401
+
+def __getattr__(name):
+    module = lazy.get(name)
+    if module is None:
+        raise AttributeError("module 'psite' has no attribute '{}'"
+                             .format(name))
+    val = getattr(importlib.import_module(module), name)
+    globals()[name] = val
+    return val
+
+
+# callers passing fast=True get orjson when it is installed, for their
+# own plain data: it falls back to json for what orjson can't write or
+# parse (NaN, non-str keys), but reads ints over 64 bits as floats.
+# Everything else, cfg.json and options.json included, uses json.
+# Names ending in .msgpack are stored with msgpack.
+serializers = None
+
+
+def get_serializers():
+    global serializers
+    if serializers is None:
+        serializers = {}
+        try:
+            # pip3 install orjson
+            import orjson
+            serializers['orjson'] = orjson
+        except ImportError:
+            pass
+        try:
+            # apt-get install python3-msgpack
+            import msgpack
+            serializers['msgpack'] = msgpack
+        except ImportError:
+            pass
+    return serializers
 
 
-def read_json(name, default=None):
+def loads_json(name, data, fast=False):
+    if name.endswith(".msgpack"):
+        return get_serializers()['msgpack'].unpackb(data)
+    orjson = get_serializers().get('orjson') if fast else None
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except(orjson.JSONDecodeError):
+            pass
+    return json.loads(data)
+
+
+def dumps_json(name, val, pretty, fast=False):
+    if name.endswith(".msgpack"):
+        return get_serializers()['msgpack'].packb(val)
+    if pretty:
+        return (json.dumps(val, sort_keys=True, indent=2) + "\n").encode()
+    orjson = get_serializers().get('orjson') if fast else None
+    if orjson is not None:
+        try:
+            return orjson.dumps(val)
+        except(TypeError):
+            pass
+    return json.dumps(val, separators=(",", ":")).encode()
+
+
+def read_json(name, default=None, fast=False):
     try:
-        with open(name) as f:
-            return json.load(f)
+        with open(name, "rb") as f:
+            return loads_json(name, f.read(), fast)
     except(OSError):
         if default is not None:
             return default
         raise
 
 
-def write_json(name, val):
-    with open("TMP.json", "w") as f:
-        f.write(json.dumps(val, sort_keys=True, indent=2))
-        f.write("\n")
-    os.rename("TMP.json", name)
+def fsync_dir(dirname):
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# readers see the old file or the new one, never a partial write, and
+# concurrent writers each use their own temp file next to the target
+def write_json(name, val, pretty=True, fast=False):
+    import threading
+    dirname = os.path.dirname(name) or "."
+    tmp = "{}/.{}.{}-{}.tmp".format(dirname, os.path.basename(name),
+                                    os.getpid(), threading.get_ident())
+    data = dumps_json(name, val, pretty, fast)
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, name)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except(OSError):
+            pass
+        raise
+    fsync_dir(dirname)
+
+
+# holds an exclusive lock on name.lock, so a read-modify-write of name
+# isn't interleaved with another process doing the same
+class json_lock:
+    def __init__(self, name):
+        self.lock_name = name + ".lock"
+        self.fd = None
+
+    def __enter__(self):
+        import fcntl
+        self.fd = os.open(self.lock_name, os.O_RDWR | os.O_CREAT, 0o666)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        os.close(self.fd)
+        self.fd = None
+
+
+# fn gets the current value (or default) and returns the new one; if it
+# returns None the value it was given is written back
+def update_json(name, fn, default=None, pretty=True, fast=False):
+    with json_lock(name):
+        val = read_json(name, {} if default is None else default, fast)
+        new_val = fn(val)
+        if new_val is None:
+            new_val = val
+        write_json(name, new_val, pretty, fast)
+    return new_val
 
 
 def slurp_file(name):
@@ -36,58 +172,149 @@ def slurp_file(name):
     return val
 
 
+# cfg.json and options.json are stat()ed at most once per
+# cfg_check_secs and reloaded when their inode, mtime or size change;
+# with watch_config() running they are only checked after inotify
+# reports a change
+cfg_check_secs = 1.0
+
 cfg = None
+cfg_sig = None
+options = None
+options_sig = None
+# bumped whenever options may have changed: a reload, use_config(),
+# or a caller that got the dict from get_options()
+options_gen = 0
+hostname = None
+flat_options = None
+flat_key = None
+next_check = 0
+watching = False
+pinned = "pinned"
 
 
-def get_cfg():
-    global cfg
-    if cfg is None:
-        cfg = read_json("cfg.json", {})
-    return cfg
+def file_sig(name):
+    try:
+        st = os.stat(name)
+    except(OSError):
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
 
 
-options = None
+# a file caught mid-write by an editor or a non-atomic copy: keep
+# using the old dict, and its old signature so the next check retries
+def reload_json(name, old):
+    global next_check
+    try:
+        return read_json(name, {})
+    except(ValueError) as e:
+        if old is None:
+            raise
+        print("warning: keeping the previous {}: {}".format(name, e),
+              file=sys.stderr)
+        # inotify may not report the file again
+        next_check = time.monotonic() + cfg_check_secs
+        return None
 
 
-def get_options():
-    global options
-    if options is None:
-        options = read_json("options.json", {})
-    return options
+def check_config():
+    global cfg, cfg_sig, options, options_sig, options_gen, next_check
+    now = time.monotonic()
+    if now < next_check:
+        return
+    next_check = float("inf") if watching else now + cfg_check_secs
 
+    if cfg_sig != pinned:
+        sig = file_sig("cfg.json")
+        if cfg is None or sig != cfg_sig:
+            new = reload_json("cfg.json", cfg)
+            if new is not None:
+                cfg = new
+                cfg_sig = sig
+
+    if options_sig != pinned:
+        sig = file_sig("options.json")
+        if options is None or sig != options_sig:
+            new = reload_json("options.json", options)
+            if new is not None:
+                options = new
+                options_sig = sig
+                options_gen += 1
+
+
+# for scratch setups like psite bench: use these dicts, never the files
+def use_config(new_cfg, new_options):
+    global cfg, cfg_sig, options, options_sig, options_gen
+    cfg = new_cfg
+    cfg_sig = pinned
+    options = new_options
+    options_sig = pinned
+    options_gen += 1
 
-def get_option(name, default=None):
-    cfg = get_cfg()
-    options = get_options()
 
-    server_name = socket.gethostname()
-    options_server = options.get(server_name, {})
-    options_site = options_server.get(cfg['siteid'], {})
+def watch_config():
+    global watching, next_check
+    try:
+        # pip3 install inotify_simple
+        import inotify_simple
+    except ImportError:
+        return False
+
+    import threading
+    ino = inotify_simple.INotify()
+    flags = inotify_simple.flags
+    ino.add_watch(".", flags.CLOSE_WRITE | flags.MOVED_TO |
+                  flags.CREATE | flags.DELETE)
+
+    def run():
+        global next_check
+        while True:
+            for event in ino.read():
+                if event.name in ("cfg.json", "options.json"):
+                    next_check = 0
+
+    threading.Thread(target=run, daemon=True).start()
+    watching = True
+    next_check = 0
+    return True
+
+
+def get_cfg():
+    check_config()
+    return cfg
+
 
-    if name in options_site:
-        return options_site[name]
-    elif name in options_server:
-        return options_server[name]
-    elif name in options:
-        return options[name]
-    else:
-        return default
+# the caller may change the dict in place
+def get_options():
+    global options_gen
+    check_config()
+    options_gen += 1
+    return options
 
 
-class MLStripper(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        self.reset()
-        self.fed = []
+# host and site options layered over the global ones in one dict,
+# rebuilt when options_gen or the siteid changes
+def get_flat_options():
+    global hostname, flat_options, flat_key
+    check_config()
+    key = (options_gen, cfg.get('siteid'))
+    if key != flat_key:
+        if hostname is None:
+            import socket
+            hostname = socket.gethostname()
+        options_server = options.get(hostname, {})
+        flat = dict(options)
+        flat.update(options_server)
+        flat.update(options_server.get(cfg.get('siteid'), {}))
+        flat_options = flat
+        flat_key = key
+    return flat_options
 
-    def handle_data(self, d):
-        self.fed.append(d)
 
-    def get_data(self):
-        return ''.join(self.fed)
+def get_option(name, default=None):
+    return get_flat_options().get(name, default)
 
 
-def strip_tags(html):
-    s = MLStripper()
-    s.feed(html)
-    return s.get_data()
+# change a global option in memory only, e.g. from a benchmark
+def set_option(name, val):
+    get_options()[name] = val
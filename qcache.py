@@ -0,0 +1,315 @@
+import re
+import json
+import time
+import threading
+import functools
+import collections
+
+import psite
+import db
+
+# opt-in cache of select results: cached_query(stmt, args) returns the
+# rows, from the cache when an entry is younger than its ttl and none
+# of the tables it reads have been written since.  Writes seen through
+# db.hooks bump a per-table generation number, once when the statement
+# runs and again at commit, so a reader can't put back rows from before
+# the commit.  Writes from outside psite (php) are only caught by the
+# ttl.  A write whose table isn't recognised bumps the "*"
+# generation, which every entry depends on; selects whose tables
+# aren't recognised are not cached.
+#
+# qcache_backend "memory" (the default) keeps entries in the process;
+# "sqlite" keeps them and the generations in aux_dir/qcache.db so that
+# all the site's processes on the host share hits and invalidations.
+
+space_re = re.compile(r"\s+")
+# "vars", `vars` and vars are the same table
+quote_re = re.compile(r"[`\"]")
+# "from a x, b as y" and "join c"
+read_tables_re = re.compile(r"""\b(?:from|join)\s+
+                                ([\w.]+(?:\s+(?:as\s+)?\w+)?
+                                 (?:\s*,\s*[\w.]+(?:\s+(?:as\s+)?\w+)?)*)""",
+                            re.IGNORECASE | re.VERBOSE)
+write_table_re = re.compile(r"""^\s*(?:insert(?:\s+or\s+\w+|\s+ignore)?\s+into
+                                   |replace\s+into
+                                   |update(?:\s+or\s+\w+|\s+ignore)?
+                                   |delete\s+from
+                                   |truncate(?:\s+table)?
+                                   |(?:drop|alter)\s+table(?:\s+if\s+exists)?)
+                                \s+([\w.]+)""",
+                            re.IGNORECASE | re.VERBOSE)
+# statements that change no table's rows
+no_write_re = re.compile(r"""^\s*(?:select|pragma|show|explain|begin|start
+                                |commit|rollback|savepoint|release|set
+                                |end)\b""", re.IGNORECASE | re.VERBOSE)
+with_re = re.compile(r"^\s*with\b", re.IGNORECASE)
+dml_re = re.compile(r"\b(?:insert|update|delete|merge|replace)\b",
+                    re.IGNORECASE)
+
+everything = "*"
+
+stats = dict(hits=0, misses=0)
+state = dict(enabled=False, backend=None)
+local = threading.local()
+
+
+# schema.table and table are the same table
+def table_name(name):
+    return name.split(".")[-1].lower()
+
+
+def read_tables(stmt):
+    tables = set()
+    for names in read_tables_re.findall(quote_re.sub("", stmt)):
+        for name in names.split(","):
+            tables.add(table_name(name.split()[0]))
+    return tuple(sorted(tables))
+
+
+# the statement with its whitespace normalized, and the generations
+# it depends on: its tables and "*", or none when no table is known
+@functools.lru_cache(maxsize=1024)
+def parse_select(stmt):
+    tables = read_tables(stmt)
+    if tables:
+        tables += (everything,)
+    return (space_re.sub(" ", stmt).strip(), tables)
+
+
+# the tables a statement may change; "*" when it can't tell
+@functools.lru_cache(maxsize=1024)
+def written_tables(stmt):
+    bare = quote_re.sub("", stmt)
+    m = write_table_re.match(bare)
+    if m is not None:
+        return (table_name(m.group(1)),)
+    if no_write_re.match(bare) or \
+       (with_re.match(bare) and not dml_re.search(bare)):
+        return ()
+    return (everything,)
+
+
+def hook(kind, stmt, secs, rows):
+    if kind == "query":
+        tables = written_tables(stmt)
+        if tables:
+            get_backend()['bump'](tables)
+            pending = getattr(local, "pending", None)
+            if pending is None:
+                pending = local.pending = set()
+            pending.update(tables)
+    elif kind == "commit":
+        pending = getattr(local, "pending", None)
+        if pending:
+            local.pending = None
+            get_backend()['bump'](pending)
+
+
+def enable():
+    if not state['enabled']:
+        state['enabled'] = True
+        db.hooks.append(hook)
+
+
+memory = dict(entries=collections.OrderedDict(),
+              gens=collections.defaultdict(int),
+              lock=threading.Lock())
+
+
+def memory_gens(tables):
+    with memory['lock']:
+        return tuple([memory['gens'][t] for t in tables])
+
+
+def memory_bump(tables):
+    with memory['lock']:
+        for t in tables:
+            memory['gens'][t] += 1
+
+
+def memory_get(key, tables):
+    with memory['lock']:
+        entry = memory['entries'].get(key)
+        if entry is None:
+            return None
+        rows, gens, expires = entry
+        if time.monotonic() >= expires or \
+           gens != tuple([memory['gens'][t] for t in tables]):
+            del memory['entries'][key]
+            return None
+        memory['entries'].move_to_end(key)
+        # a new list each hit, so callers can't change the entry
+        return list(rows)
+
+
+def memory_put(key, tables, gens, rows, ttl):
+    limit = int(psite.get_option("qcache_max", 1000))
+    with memory['lock']:
+        memory['entries'][key] = (tuple(rows), gens,
+                                  time.monotonic() + ttl)
+        memory['entries'].move_to_end(key)
+        while len(memory['entries']) > limit:
+            memory['entries'].popitem(last=False)
+
+
+def memory_clear():
+    with memory['lock']:
+        memory['entries'].clear()
+
+
+# the shared backend uses wall clock times, as it spans processes
+shared = dict(conn=None, lock=threading.Lock(), puts=0)
+
+
+def shared_conn():
+    if shared['conn'] is None:
+        import sqlite3
+        cfg = psite.get_cfg()
+        filename = psite.get_option("qcache_path",
+                                    "{}/qcache.db".format(cfg['aux_dir']))
+        conn = sqlite3.connect(filename, timeout=5, isolation_level=None,
+                               check_same_thread=False)
+        # only a cache: losing the last writes in a crash is fine
+        conn.execute("pragma journal_mode = wal")
+        conn.execute("pragma synchronous = off")
+        conn.execute("create table if not exists entries"
+                     " (key text primary key, tables text, gens text,"
+                     "  expires real, used real, rows text)")
+        conn.execute("create index if not exists entries_used"
+                     " on entries (used)")
+        conn.execute("create table if not exists gens"
+                     " (tbl text primary key, gen integer)")
+        shared['conn'] = conn
+    return shared['conn']
+
+
+def shared_gens(tables):
+    if not tables:
+        return []
+    with shared['lock']:
+        have = dict(shared_conn().execute(
+            "select tbl, gen from gens where tbl in ({})".format(
+                ", ".join(["?"] * len(tables))), tables).fetchall())
+    return [have.get(t, 0) for t in tables]
+
+
+def shared_bump(tables):
+    with shared['lock']:
+        shared_conn().executemany(
+            "insert into gens (tbl, gen) values (?, 1)"
+            " on conflict (tbl) do update set gen = gen + 1",
+            [(t,) for t in tables])
+
+
+def shared_key(key):
+    return json.dumps(key, default=str)
+
+
+def shared_get(key, tables):
+    key = shared_key(key)
+    with shared['lock']:
+        conn = shared_conn()
+        r = conn.execute("select gens, expires, used, rows from entries"
+                         " where key = ?", (key,)).fetchone()
+        if r is None:
+            return None
+        gens, expires, used, rows = r
+        now = time.time()
+        if now >= expires:
+            conn.execute("delete from entries where key = ?", (key,))
+            return None
+        # lru order only needs to be roughly right; don't write per hit
+        if now - used > 10:
+            conn.execute("update entries set used = ? where key = ?",
+                         (now, key))
+    if json.loads(gens) != shared_gens(tables):
+        return None
+    return [tuple(row) for row in json.loads(rows)]
+
+
+def shared_put(key, tables, gens, rows, ttl):
+    try:
+        data = json.dumps(rows)
+    except(TypeError, ValueError):
+        # only plain values are shared
+        return
+    now = time.time()
+    with shared['lock']:
+        conn = shared_conn()
+        conn.execute("insert or replace into entries"
+                     " (key, tables, gens, expires, used, rows)"
+                     " values (?, ?, ?, ?, ?, ?)",
+                     (shared_key(key), json.dumps(tables), json.dumps(gens),
+                      now + ttl, now, data))
+        shared['puts'] += 1
+        if shared['puts'] % 100 == 0:
+            trim(conn, now)
+
+
+# drop expired entries and the least recently used beyond qcache_max
+def trim(conn, now):
+    limit = int(psite.get_option("qcache_max", 1000))
+    conn.execute("delete from entries where expires <= ?", (now,))
+    count = conn.execute("select count(*) from entries").fetchone()[0]
+    extra = count - limit
+    if extra > 0:
+        conn.execute("delete from entries where key in"
+                     " (select key from entries order by used limit ?)",
+                     (extra,))
+
+
+def shared_clear():
+    with shared['lock']:
+        shared_conn().execute("delete from entries")
+
+
+backends = dict(
+    memory=dict(gens=memory_gens, bump=memory_bump, get=memory_get,
+                put=memory_put, clear=memory_clear),
+    sqlite=dict(gens=shared_gens, bump=shared_bump, get=shared_get,
+                put=shared_put, clear=shared_clear))
+
+
+def get_backend():
+    if state['backend'] is None:
+        state['backend'] = backends[psite.get_option("qcache_backend",
+                                                     "memory")]
+    return state['backend']
+
+
+# rows of a select, cached for ttl seconds (qcache_ttl by default)
+def cached_query(stmt, args=(), ttl=None):
+    if not state['enabled']:
+        enable()
+    # this thread's uncommitted writes aren't in the cache
+    primary = getattr(db.local, "db", None)
+    if primary is not None and primary['pending']:
+        db.query(stmt, args)
+        return db.fetchall()
+
+    backend = state['backend'] or get_backend()
+    normalized, tables = parse_select(stmt)
+    if not tables:
+        db.query(stmt, args)
+        return db.fetchall()
+    key = (normalized, tuple(args))
+    rows = backend['get'](key, tables)
+    if rows is not None:
+        stats['hits'] += 1
+        return rows
+
+    stats['misses'] += 1
+    # generations from before the query, so a write racing with it
+    # leaves an entry that is already out of date
+    gens = backend['gens'](tables)
+    db.query(stmt, args)
+    rows = [tuple(row) for row in db.fetchall()]
+    if ttl is None:
+        ttl = float(psite.get_option("qcache_ttl", 60))
+    backend['put'](key, tables, gens, rows, ttl)
+    return rows
+
+
+def clear():
+    get_backend()['clear']()
+
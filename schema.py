@@ -0,0 +1,405 @@
+import re
+import sys
+from collections import OrderedDict
+
+import psite
+import db
+
+# tables psite itself depends on, created with these columns when a
+# site's schema file doesn't declare them.  varchar so that mysql can
+# index the whole name.
+builtin_tables = [("seqs", [("name", "varchar(191)"),
+                            ("lastval", "integer")])]
+
+# lookup columns psite itself depends on, indexed whether or not a
+# site's schema file mentions them
+builtin_indexes = [("vars", ["var"], True),
+                   ("seqs", ["name"], True)]
+
+# equality lookups made by psite's own queries, python and php
+lookups = [("vars", "var"),
+           ("seqs", "name"),
+           ("sessions", "session_id")]
+
+
+def index_name(table, columns):
+    return "{}_{}".format(table, "_".join(columns))
+
+
+def new_table():
+    return dict(columns=OrderedDict(), indexes=OrderedDict(), primary=None)
+
+
+def parse_columns(filename, linenum, tables, table, words):
+    if len(words) != 2:
+        raise ValueError("{}:{}: wrong number of args"
+                         .format(filename, linenum))
+    columns = words[1].split(",")
+    for column in columns:
+        if column not in tables[table]['columns']:
+            raise ValueError("{}:{}: no column {} in {}".format(
+                filename, linenum, column, table))
+    return columns
+
+
+def parse_schema(filename="schema"):
+    tables = OrderedDict()
+    with open(filename) as f:
+        table = None
+        linenum = 0
+        for line in f:
+            linenum = linenum + 1
+            line = re.sub(re.compile("#.*"), "", line).strip()
+            words = re.split("\\s+", line)
+            if words[0] == "":
+                continue
+            if words[0] != "table" and table is None:
+                raise ValueError("{}:{}: {} before any table"
+                                 .format(filename, linenum, words[0]))
+            if words[0] == "table":
+                if len(words) != 2:
+                    raise ValueError("{}:{}: wrong number of args"
+                                     .format(filename, linenum))
+                table = words[1]
+                tables.setdefault(table, new_table())
+            elif words[0] == "col":
+                # col NAME TYPE [default VALUE]
+                if len(words) != 3 and \
+                   (len(words) < 5 or words[3] != "default"):
+                    raise ValueError("{}:{}: wrong number of args"
+                                     .format(filename, linenum))
+                default = None
+                if len(words) >= 5:
+                    default = " ".join(words[4:])
+                tables[table]['columns'][words[1]] = dict(
+                    type=words[2], default=default)
+            elif words[0] in ("index", "unique"):
+                # index COL[,COL...] or unique COL[,COL...]
+                columns = parse_columns(filename, linenum,
+                                        tables, table, words)
+                tables[table]['indexes'][index_name(table, columns)] = \
+                    dict(columns=columns, unique=words[0] == "unique")
+            elif words[0] == "primary":
+                # primary COL[,COL...]
+                if tables[table]['primary'] is not None:
+                    raise ValueError("{}:{}: second primary key for {}"
+                                     .format(filename, linenum, table))
+                tables[table]['primary'] = parse_columns(
+                    filename, linenum, tables, table, words)
+            else:
+                raise ValueError("{}:{}: unknown directive {}"
+                                 .format(filename, linenum, words[0]))
+
+    for table, columns in builtin_tables:
+        if table not in tables:
+            tables[table] = new_table()
+            for column, coltype in columns:
+                tables[table]['columns'][column] = dict(type=coltype,
+                                                        default=None)
+
+    for table, columns, unique in builtin_indexes:
+        if table in tables and tables[table]['primary'] != columns:
+            tables[table]['indexes'][index_name(table, columns)] = \
+                dict(columns=columns, unique=unique)
+    return tables
+
+
+def add_columns(tables, rows):
+    for table, column, coltype, default in rows:
+        tables.setdefault(table, new_table())['columns'][column] = dict(
+            type=coltype, default=default)
+    return tables
+
+
+# rows of (table, index, unique, primary, column) in column order
+def add_indexes(tables, rows):
+    for table, index, unique, primary, column in rows:
+        have = tables.setdefault(table, new_table())
+        if primary:
+            have['primary'] = (have['primary'] or []) + [column]
+            continue
+        have['indexes'].setdefault(index, dict(columns=[],
+                                               unique=bool(unique)))
+        have['indexes'][index]['columns'].append(column)
+    return tables
+
+
+def sqlite3_catalog():
+    db.query("select m.name, p.name, p.type, p.dflt_value"
+             " from sqlite_master m"
+             " join pragma_table_info(m.name) p"
+             " where m.type = 'table'"
+             " order by m.name, p.cid")
+    tables = add_columns(OrderedDict(), db.fetchall())
+
+    # an integer primary key is the rowid and has no index of its own
+    db.query("select m.name, null, 1, 1, p.name"
+             " from sqlite_master m"
+             " join pragma_table_info(m.name) p"
+             " where m.type = 'table' and p.pk > 0"
+             " order by m.name, p.pk")
+    add_indexes(tables, db.fetchall())
+
+    db.query("select m.tbl_name, m.name, l.\"unique\", 0, i.name"
+             " from sqlite_master m"
+             " join pragma_index_list(m.tbl_name) l on l.name = m.name"
+             " join pragma_index_info(m.name) i"
+             " where m.type = 'index' and l.origin != 'pk'"
+             " order by m.tbl_name, m.name, i.seqno")
+    return add_indexes(tables, db.fetchall())
+
+
+def postgres_catalog():
+    db.query("select table_name, column_name, data_type, column_default"
+             " from information_schema.columns"
+             " where table_schema = 'public'"
+             " order by table_name, ordinal_position")
+    tables = add_columns(OrderedDict(), db.fetchall())
+
+    db.query("select t.relname, i.relname, x.indisunique, x.indisprimary,"
+             "   a.attname"
+             " from pg_index x"
+             " join pg_class i on i.oid = x.indexrelid"
+             " join pg_class t on t.oid = x.indrelid"
+             " join pg_namespace n on n.oid = t.relnamespace"
+             " join pg_attribute a"
+             "   on a.attrelid = t.oid and a.attnum = any(x.indkey)"
+             " where n.nspname = 'public'"
+             " order by t.relname, i.relname,"
+             "   array_position(x.indkey::int2[], a.attnum)")
+    return add_indexes(tables, db.fetchall())
+
+
+def mysql_catalog():
+    cfg = psite.get_cfg()
+    db.query("select table_name, column_name, data_type, column_default"
+             " from information_schema.columns"
+             " where table_schema = ?"
+             " order by table_name, ordinal_position",
+             (cfg['dbname'],))
+    tables = add_columns(OrderedDict(), db.fetchall())
+
+    db.query("select table_name, index_name, non_unique = 0,"
+             "   index_name = 'PRIMARY', column_name"
+             " from information_schema.statistics"
+             " where table_schema = ?"
+             " order by table_name, index_name, seq_in_index",
+             (cfg['dbname'],))
+    return add_indexes(tables, db.fetchall())
+
+
+catalogs = dict(sqlite3=sqlite3_catalog,
+                postgres=postgres_catalog,
+                mysql=mysql_catalog)
+
+
+def column_def(dbtype, column, spec):
+    stmt = "{} {}".format(column, spec['type'])
+    if dbtype == "mysql" and spec['type'] == "timestamp":
+        stmt += " null"
+    if spec['default'] is not None:
+        stmt += " default {}".format(spec['default'])
+    return stmt
+
+
+# mysql can only index text columns by prefix
+def prefix_columns(dbtype, wanted, columns):
+    if dbtype != "mysql":
+        return []
+    return [column for column in wanted
+            if columns.get(column, {}).get('type', "").lower()
+            in ("text", "blob")]
+
+
+def index_columns(dbtype, wanted, columns):
+    prefixed = prefix_columns(dbtype, wanted, columns)
+    return ", ".join(["{}(191)".format(column) if column in prefixed
+                      else column for column in wanted])
+
+
+# a unique prefix index would reject values that only differ after
+# their first 191 characters, so they get a plain index instead
+def usable_index(dbtype, table, index, spec, columns):
+    prefixed = prefix_columns(dbtype, spec['columns'], columns)
+    if not spec['unique'] or not prefixed:
+        return spec
+    print("warning: mysql can only index {} of {} by prefix; making {}"
+          " a plain index.  For a unique key use: col {} varchar(191)"
+          .format(", ".join(prefixed), table, index, prefixed[0]))
+    return dict(spec, unique=False)
+
+
+def primary_ok(dbtype, table, wanted, columns):
+    prefixed = prefix_columns(dbtype, wanted, columns)
+    if prefixed:
+        print("warning: mysql can only index {} of {} by prefix; not"
+              " making it the primary key.  Use: col {} varchar(191)"
+              .format(", ".join(prefixed), table, prefixed[0]))
+    return not prefixed
+
+
+def index_def(dbtype, table, index, spec, columns):
+    return "create {}index {} on {} ({})".format(
+        "unique " if spec['unique'] else "", index, table,
+        index_columns(dbtype, spec['columns'], columns))
+
+
+def drop_index(dbtype, table, index):
+    if dbtype == "mysql":
+        return "drop index {} on {}".format(index, table)
+    return "drop index {}".format(index)
+
+
+def diff_columns(dbtype, table, want, have):
+    plan = []
+    for column, spec in want['columns'].items():
+        if column not in have['columns']:
+            plan.append("alter table {} add {}".format(
+                table, column_def(dbtype, column, spec)))
+        elif spec['default'] is not None and \
+                have['columns'][column]['default'] is None:
+            if dbtype == "sqlite3":
+                print("warning: sqlite3 can't add a default"
+                      " to existing column {}.{}"
+                      .format(table, column))
+                continue
+            plan.append("alter table {} alter column {}"
+                        " set default {}".format(
+                            table, column, spec['default']))
+    return plan
+
+
+def diff_primary(dbtype, table, want, have):
+    if want['primary'] is None or want['primary'] == have['primary'] or \
+       not primary_ok(dbtype, table, want['primary'], want['columns']):
+        return []
+    if dbtype == "sqlite3":
+        # sqlite3 can't alter the key of an existing table
+        index = "{}_pkey".format(table)
+        if index in have['indexes']:
+            return []
+        print("warning: sqlite3 can't change the primary key of {};"
+              " using a unique index instead".format(table))
+        return [index_def(dbtype, table, index,
+                          dict(columns=want['primary'], unique=True),
+                          want['columns'])]
+    plan = []
+    if have['primary'] is not None:
+        plan.append("alter table {} drop primary key".format(table)
+                    if dbtype == "mysql" else
+                    "alter table {0} drop constraint {0}_pkey".format(table))
+    plan.append("alter table {} add primary key ({})".format(
+        table, index_columns(dbtype, want['primary'], want['columns'])))
+    return plan
+
+
+# indexes named the way mkschema names them but no longer in the
+# schema are only dropped with --prune
+def diff_indexes(dbtype, table, want, have, prune):
+    plan = []
+    for index, spec in want['indexes'].items():
+        spec = usable_index(dbtype, table, index, spec, want['columns'])
+        old = have['indexes'].get(index)
+        if old == spec:
+            continue
+        if old is not None:
+            plan.append(drop_index(dbtype, table, index))
+        plan.append(index_def(dbtype, table, index, spec, want['columns']))
+
+    for index in have['indexes']:
+        if index in want['indexes'] or \
+           not index.startswith(table + "_") or \
+           index == "{}_pkey".format(table):
+            continue
+        if prune:
+            plan.append(drop_index(dbtype, table, index))
+        else:
+            print("note: index {} on {} is not in the schema"
+                  .format(index, table))
+    return plan
+
+
+def diff_schema(tables, catalog, prune=False):
+    dbtype = db.get_db()['db']
+    plan = []
+    for table, want in tables.items():
+        have = catalog.get(table)
+        if have is None:
+            defs = [column_def(dbtype, column, spec)
+                    for column, spec in want['columns'].items()]
+            if want['primary'] is not None and \
+               primary_ok(dbtype, table, want['primary'], want['columns']):
+                defs.append("primary key ({})".format(index_columns(
+                    dbtype, want['primary'], want['columns'])))
+            plan.append("create table {} ({})".format(table, ", ".join(defs)))
+            have = new_table()
+            have['columns'] = want['columns']
+            have['primary'] = want['primary']
+        else:
+            plan += diff_columns(dbtype, table, want, have)
+            plan += diff_primary(dbtype, table, want, have)
+        plan += diff_indexes(dbtype, table, want, have, prune)
+    return plan
+
+
+def has_index(spec, column):
+    if spec['primary'] is not None and spec['primary'][0] == column:
+        return True
+    for index in spec['indexes'].values():
+        if index['columns'][0] == column:
+            return True
+    return False
+
+
+def check_lookups(tables):
+    for table, column in lookups:
+        if table in tables and not has_index(tables[table], column):
+            print("warning: psite looks up {} by {} but the schema"
+                  " has no index for it; add: unique {}"
+                  .format(table, column, column))
+
+
+# carry the value of the old single row seq table over to seqs
+def migrate_seq():
+    if not db.table_exists("seq") or not db.table_exists("seqs"):
+        return
+    db.query("select 0 from seqs where name = 'default'")
+    if db.fetch() is not None:
+        return
+    db.query("select lastval from seq")
+    r = db.fetch()
+    if r is not None and r[0] is not None:
+        print("migrating seq to seqs")
+        db.query("insert into seqs (name, lastval) values ('default', ?)",
+                 (r[0],))
+
+
+def apply_plan(plan):
+    # postgres ddl is transactional; mysql commits after each statement
+    with db.transaction() as d:
+        for stmt in plan:
+            print(stmt)
+            d['cursor'].execute(stmt)
+        migrate_seq()
+
+
+def mkschema():
+    dry_run = "--dry-run" in sys.argv[2:]
+    prune = "--prune" in sys.argv[2:]
+
+    with psite.phase("parse"):
+        tables = parse_schema("schema")
+        check_lookups(tables)
+    dbtype = db.get_db()['db']
+    with psite.phase("catalog"), db.primary_reads():
+        catalog = catalogs[dbtype]()
+    with psite.phase("diff"):
+        plan = diff_schema(tables, catalog, prune)
+
+    if dry_run:
+        for stmt in plan:
+            print(stmt)
+        return
+
+    with psite.phase("apply"):
+        apply_plan(plan)
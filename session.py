@@ -0,0 +1,292 @@
+import re
+import time
+import atexit
+import threading
+import collections
+
+import psite
+import db
+
+# the sessions table shared with the php handlers in psite.php.  Reads
+# go through a small lru cache, writes of unchanged data only touch
+# updated, and touches are batched.
+
+# php serialize() format, as used by the default "php" session
+# serialize_handler: name|value name|value ...
+
+php_scalar = re.compile(rb'([Nbid]):?([^;]*);')
+
+
+def php_unserialize_at(data, pos):
+    kind = data[pos:pos + 1]
+    if kind in (b"N", b"b", b"i", b"d"):
+        m = php_scalar.match(data, pos)
+        if m is None:
+            raise ValueError("bad php value at {}".format(pos))
+        val = m.group(2).decode()
+        if kind == b"N":
+            return None, m.end()
+        elif kind == b"b":
+            return val == "1", m.end()
+        elif kind == b"i":
+            return int(val), m.end()
+        return float(val), m.end()
+    elif kind == b"s":
+        colon = data.index(b":", pos + 2)
+        length = int(data[pos + 2:colon])
+        start = colon + 2
+        val = data[start:start + length].decode("utf-8", "surrogateescape")
+        return val, start + length + 2
+    elif kind in (b"a", b"O"):
+        if kind == b"O":
+            # objects come back as dicts; the class name is dropped
+            colon = data.index(b":", pos + 2)
+            length = int(data[pos + 2:colon])
+            pos = colon + 2 + length + 1
+        else:
+            pos += 1
+        colon = data.index(b":", pos + 1)
+        count = int(data[pos + 1:colon])
+        pos = colon + 2
+        val = collections.OrderedDict()
+        for i in range(count):
+            key, pos = php_unserialize_at(data, pos)
+            val[key], pos = php_unserialize_at(data, pos)
+        return val, pos + 1
+    raise ValueError("unsupported php value {!r} at {}".format(kind, pos))
+
+
+def php_unserialize(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8", "surrogateescape")
+    return php_unserialize_at(data, 0)[0]
+
+
+def php_serialize(val):
+    if val is None:
+        return "N;"
+    elif isinstance(val, bool):
+        return "b:{};".format(int(val))
+    elif isinstance(val, int):
+        return "i:{};".format(val)
+    elif isinstance(val, float):
+        if val != val:
+            return "d:NAN;"
+        elif val in (float("inf"), float("-inf")):
+            return "d:{}INF;".format("-" if val < 0 else "")
+        return "d:{};".format(repr(val))
+    elif isinstance(val, str):
+        return 's:{}:"{}";'.format(
+            len(val.encode("utf-8", "surrogateescape")), val)
+    elif isinstance(val, (list, tuple)):
+        val = dict(enumerate(val))
+    elif not isinstance(val, dict):
+        raise ValueError("can't php serialize {}".format(type(val)))
+    return "a:{}:{{{}}}".format(
+        len(val), "".join([php_serialize(k) + php_serialize(v)
+                           for k, v in val.items()]))
+
+
+def session_decode(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8", "surrogateescape")
+    sess = collections.OrderedDict()
+    pos = 0
+    while pos < len(data):
+        bar = data.index(b"|", pos)
+        name = data[pos:bar].decode("utf-8", "surrogateescape")
+        sess[name], pos = php_unserialize_at(data, bar + 1)
+    return sess
+
+
+def session_encode(sess):
+    return "".join(["{}|{}".format(name, php_serialize(val))
+                    for name, val in sess.items()])
+
+
+# session_id -> [data, fetched, updated]: fetched is monotonic, updated
+# is the row's updated column in epoch seconds
+session_cache = collections.OrderedDict()
+session_lock = threading.Lock()
+# session_id -> updated timestamp waiting to be written
+session_touches = {}
+session_state = dict(flushed=time.monotonic(), atexit=False)
+
+upserts = dict(
+    sqlite3=("insert or replace into sessions (session_id, updated, session)"
+             " values (?, ?, ?)"),
+    postgres=("insert into sessions (session_id, updated, session)"
+              " values (?, ?, ?)"
+              " on conflict (session_id) do update"
+              " set updated = excluded.updated, session = excluded.session"),
+    mysql=("insert into sessions (session_id, updated, session)"
+           " values (?, ?, ?)"
+           " on duplicate key update"
+           " updated = values(updated), session = values(session)"))
+
+
+# same format psite.php writes
+def session_timestamp(secs=None):
+    return time.strftime("%Y-%m-%d %H:%M:%S",
+                         time.localtime(secs))
+
+
+# the updated column back in epoch seconds; postgres returns datetimes
+def session_secs(updated):
+    if updated is None:
+        return 0
+    if not isinstance(updated, str):
+        return time.mktime(updated.timetuple())
+    return time.mktime(time.strptime(updated[:19], "%Y-%m-%d %H:%M:%S"))
+
+
+def cached_session(session_id):
+    ttl = float(psite.get_option("session_cache_ttl", 1))
+    with session_lock:
+        entry = session_cache.get(session_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[1] >= ttl:
+            # php may have written it since
+            del session_cache[session_id]
+            return None
+        session_cache.move_to_end(session_id)
+        return entry
+
+
+def cache_session(session_id, data, updated):
+    limit = int(psite.get_option("session_cache_max", 1000))
+    with session_lock:
+        session_cache[session_id] = [data, time.monotonic(), updated]
+        session_cache.move_to_end(session_id)
+        while len(session_cache) > limit:
+            session_cache.popitem(last=False)
+
+
+def read_session(session_id):
+    entry = cached_session(session_id)
+    if entry is not None:
+        return entry[0]
+    # written back by write_session, so never from a lagging replica
+    with db.primary_reads():
+        db.query("select session, updated from sessions"
+                 " where session_id = ?", (session_id,))
+        r = db.fetch()
+    if r is None:
+        cache_session(session_id, "", 0)
+        return ""
+    cache_session(session_id, r[0], session_secs(r[1]))
+    return r[0]
+
+
+def write_session(session_id, data):
+    if data.strip() == "":
+        destroy_session(session_id)
+        return
+
+    entry = cached_session(session_id)
+    now = time.time()
+    if entry is not None and entry[0] == data:
+        # unchanged: only keep it from expiring, once updated is
+        # session_touch_secs old, batched with other touches
+        if now - entry[2] >= float(psite.get_option("session_touch_secs",
+                                                    60)):
+            with session_lock:
+                entry[2] = now
+                session_touches[session_id] = session_timestamp(now)
+                register_flush()
+        flush_touches(force=False)
+        return
+
+    conn = db.get_db()
+    if db.has_unique_key("sessions", "session_id"):
+        db.query(upserts[conn['db']],
+                 (session_id, session_timestamp(now), data))
+    else:
+        db.update_or_insert("sessions", "session_id", session_id,
+                            dict(updated=session_timestamp(now),
+                                 session=data))
+    db.commit()
+    with session_lock:
+        session_touches.pop(session_id, None)
+    cache_session(session_id, data, now)
+    flush_touches(force=False)
+
+
+def destroy_session(session_id):
+    db.query("delete from sessions where session_id = ?", (session_id,))
+    db.commit()
+    with session_lock:
+        session_cache.pop(session_id, None)
+        session_touches.pop(session_id, None)
+
+
+def register_flush():
+    if not session_state['atexit']:
+        session_state['atexit'] = True
+        atexit.register(flush_touches)
+
+
+# write pending touches once there are session_touch_batch of them or
+# session_flush_secs have passed; force writes them regardless
+def flush_touches(force=True):
+    now = time.monotonic()
+    with session_lock:
+        if not session_touches:
+            session_state['flushed'] = now
+            return 0
+        if not force and \
+           len(session_touches) < int(psite.get_option(
+               "session_touch_batch", 100)) and \
+           now - session_state['flushed'] < float(psite.get_option(
+               "session_flush_secs", 10)):
+            return 0
+        rows = [(ts, session_id)
+                for session_id, ts in session_touches.items()]
+        session_touches.clear()
+        session_state['flushed'] = now
+    return db.query_many("update sessions set updated = ?"
+                         " where session_id = ?", rows)
+
+
+def get_session(session_id):
+    data = read_session(session_id)
+    if data == "":
+        return collections.OrderedDict()
+    return session_decode(data)
+
+
+def save_session(session_id, sess):
+    write_session(session_id, session_encode(sess))
+
+
+# delete sessions idle for more than lifetime seconds, batch rows per
+# transaction instead of one long delete, walking the sessions_updated
+# index
+def gc_sessions(lifetime=None, batch=None):
+    if lifetime is None:
+        lifetime = int(psite.get_option("session_lifetime", 1440))
+    if not db.table_exists("sessions"):
+        return 0
+    batch = db.get_batch_size(batch)
+    flush_touches()
+    cutoff = session_timestamp(time.time() - lifetime)
+    total = 0
+    while True:
+        with db.primary_reads():
+            db.query("select session_id from sessions"
+                     " where updated < ?"
+                     " order by updated"
+                     " limit ?",
+                     (cutoff, batch))
+            ids = [r[0] for r in db.fetchall()]
+        if not ids:
+            break
+        total += db.query_many("delete from sessions where session_id = ?",
+                               [(session_id,) for session_id in ids],
+                               batch)
+        if len(ids) < batch:
+            break
+    with session_lock:
+        session_cache.clear()
+    return total
@@ -0,0 +1,98 @@
+import html
+import re
+import threading
+from html.parser import HTMLParser
+
+
+class MLStripper(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.reset()
+        self.fed = []
+
+    def handle_data(self, d):
+        self.fed.append(d)
+
+    def get_data(self):
+        return ''.join(self.fed)
+
+    # hand over the text collected so far, for streaming
+    def take_data(self):
+        fed = self.fed
+        self.fed = []
+        return fed
+
+    def start(self):
+        self.reset()
+        self.fed = []
+
+
+# one parser per thread, reset between documents instead of rebuilt
+local = threading.local()
+
+
+def get_stripper():
+    s = getattr(local, "stripper", None)
+    if s is None:
+        s = MLStripper()
+        local.stripper = s
+    return s
+
+
+# plain start and end tags, with quotes only around attribute values;
+# documents where every '<' begins one of these are split with a regex
+# instead of going through HTMLParser
+tag_re = re.compile(r"""<(?:/?[a-zA-Z][-\w:.]*"""
+                    r"""(?:\s+[-\w:.]+(?:\s*=\s*(?:"[^"]*"|'[^']*'"""
+                    r"""|[^\s"'<>=`]+))?)*\s*/?)>""")
+
+# elements whose contents the parser does not treat as markup
+raw_re = re.compile(r"<(?:script|style|textarea|title|xmp|iframe|noembed"
+                    r"|noframes|noscript|plaintext)\b", re.IGNORECASE)
+
+
+def unescape(text):
+    if '&' not in text:
+        return text
+    return html.unescape(text)
+
+
+def strip_tags(html_text):
+    # no markup: only entities to decode, same as the parser does
+    if '<' not in html_text:
+        return unescape(html_text)
+    if not raw_re.search(html_text):
+        parts = tag_re.split(html_text)
+        for part in parts:
+            if '<' in part:
+                break
+        else:
+            return ''.join([unescape(part) for part in parts])
+    s = get_stripper()
+    s.start()
+    s.feed(html_text)
+    s.close()
+    return s.get_data()
+
+
+def strip_tags_many(docs):
+    return [strip_tags(doc) for doc in docs]
+
+
+# yields the text of a document given as an iterator of string chunks,
+# holding at most one chunk plus any unfinished tag in memory
+def iter_strip_tags(chunks):
+    s = MLStripper()
+    for chunk in chunks:
+        s.feed(chunk)
+        fed = s.take_data()
+        if fed:
+            yield ''.join(fed)
+    s.close()
+    fed = s.take_data()
+    if fed:
+        yield ''.join(fed)
+
+
+def strip_tags_file(f, chunk_size=64 * 1024):
+    return iter_strip_tags(iter(lambda: f.read(chunk_size), ''))